@@ -4,10 +4,23 @@
 """AMQP adapters for the scheduler."""
 
 from functools import wraps
+import random
+from collections import deque
+import socket
 import logging
-from gevent import queue, sleep, getcurrent
+import gevent
+from gevent import queue, getcurrent, select
+from gevent.coros import RLock, Semaphore
+from gevent.event import AsyncResult
+from gevent.socket import wait_read
+from gevent.timeout import Timeout
 from time import time
+from urllib import quote
+from zlib import crc32
 
+import requests
+#import ujson as json
+import simplejson as json
 from arachne.conf import settings, merge, require
 from arachne.utils import ConnectionPool
 from kombu.transport.amqplib import Connection, amqp
@@ -17,10 +30,190 @@ defaults = {
     "prefetch_count": 20,
     "queue_size": 100,
     "poolsize": 5,
+    # Publisher batching
+    "publish_batch_size": 500,
+    "publish_interval": 0.05,
+    "publish_confirm": False,
+    # Consumer acks
+    "ack_every": 20,
+    # queue status snapshots are shared for this long;  with status_url, they
+    # come from a management api rather than a passive queue declare
+    "status_ttl": 10,
+    "status_url": None,
+    # priority lanes, listed from highest priority with their weights, eg.
+    # "interactive:10,scheduled:3,backfill:1", and how many queues to shard
+    # each lane over;  without either, the one `queue` is used
+    "lanes": None,
+    "default_lane": None,
+    "shards": 1,
 }
 
 logger = logging.getLogger(__name__)
 
+class Meter(object):
+    """Counts events, and their rate per second over the last `window`
+    seconds."""
+    def __init__(self, window=60):
+        self.window = window
+        self.count = 0
+        # [second, count] pairs
+        self.buckets = deque()
+
+    def mark(self, n=1):
+        self.count += n
+        second = int(time())
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += n
+        else:
+            self.buckets.append([second, n])
+            self.expire(second)
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+
+    def rate(self):
+        self.expire(int(time()))
+        return sum(count for second, count in self.buckets) / float(self.window)
+
+# messages published, delivered and acked by this process
+meters = {
+    "published": Meter(),
+    "delivered": Meter(),
+    "acked": Meter(),
+}
+
+def rates():
+    """Return the counts and per second rates of messages published,
+    delivered and acked by this process."""
+    d = {}
+    for name, meter in meters.iteritems():
+        d[name] = meter.count
+        d[name + "_rate"] = meter.rate()
+    return d
+
+class QueueStatus(object):
+    """A snapshot of a queue's status, shared by every greenlet and
+    refreshed at most every `status_ttl` seconds, so monitoring doesn't take
+    a connection (or a round trip) per caller.  While one greenlet refreshes
+    it, the others are given the previous snapshot.
+
+    The status is read with a passive queue declare, or, if `status_url` is
+    set, from a management api:  RabbitMQ's /api/queues/<vhost>/<queue>, or
+    anything serving the same json (eg. a local stand-in which aggregates
+    it).  From the api, the broker's message rates are also included.  With
+    lanes or shards, each of their queues is read and the status is their
+    total (see `combine_status`)."""
+    def __init__(self, client):
+        self.client = client
+        self.ttl = float(client.config.get("status_ttl") or 0)
+        self.url = client.config.get("status_url")
+        self.snapshot = None
+        self.updated = 0
+        self.refresh = None
+        self.stats = {"refreshes": 0, "errors": 0}
+
+    def get(self, cached=True):
+        if cached and self.snapshot is not None and time() - self.updated < self.ttl:
+            return self.snapshot
+        if self.refresh is not None:
+            return self.snapshot if self.snapshot is not None else self.refresh.get()
+        self.refresh = refresh = AsyncResult()
+        try:
+            self.snapshot = self.fetch()
+            self.updated = time()
+            self.stats["refreshes"] += 1
+            refresh.set(self.snapshot)
+            return self.snapshot
+        except Exception, e:
+            self.stats["errors"] += 1
+            refresh.set_exception(e)
+            raise
+        finally:
+            self.refresh = None
+
+    def fetch(self):
+        if not self.url:
+            return self.client.declare_status()
+        c = self.client.config
+        return combine_status(c["queue"], [self.fetch_url(queue) for queue in queues(c)])
+
+    def fetch_url(self, queue):
+        c = self.client.config
+        url = self.url % {"vhost": quote(c["vhost"], ""), "queue": quote(queue, "")}
+        response = requests.get(url, auth=(c["username"], c["password"]), timeout=5)
+        response.raise_for_status()
+        data = json.loads(response.content)
+        stats = data.get("message_stats", {})
+        rate = lambda key: stats.get(key + "_details", {}).get("rate", 0.0)
+        return dict(name=data.get("name", queue), messages=data.get("messages", 0),
+            consumers=data.get("consumers", 0), publish_rate=rate("publish"),
+            deliver_rate=rate("deliver_get"), ack_rate=rate("ack"))
+
+def combine_status(name, statuses):
+    """Combine the statuses of a lane's or shard's queues into one for name:
+    messages and rates are summed, consumers (who consume every queue) are
+    the most on any queue, and `queues` has the messages in each."""
+    if len(statuses) == 1:
+        return statuses[0]
+    status = dict(name=name, messages=0, consumers=0, queues={})
+    for s in statuses:
+        status["messages"] += s["messages"]
+        status["consumers"] = max(status["consumers"], s["consumers"])
+        status["queues"][s["name"]] = s["messages"]
+        for key in ("publish_rate", "deliver_rate", "ack_rate"):
+            if key in s:
+                status[key] = status.get(key, 0.0) + s[key]
+    return status
+
+def lanes(config):
+    """Return [(name, weight)] for the configured lanes, or [(None, 1)]."""
+    spec = config.get("lanes")
+    if not spec:
+        return [(None, 1)]
+    result = []
+    for lane in spec.split(","):
+        name, _, weight = lane.strip().partition(":")
+        result.append((name, float(weight or 1)))
+    return result
+
+def queue_name(config, lane=None, shard=None):
+    name = config["queue"]
+    if lane is not None:
+        name += "." + lane
+    if shard is not None and int(config.get("shards") or 1) > 1:
+        name += ".%d" % shard
+    return name
+
+def lane_queues(config):
+    """Return (lane, queue, weight) for every queue that jobs are published
+    to, with each lane's weight divided among its shards."""
+    shards = int(config.get("shards") or 1)
+    return [(name, queue_name(config, name, shard), weight / shards)
+        for name, weight in lanes(config) for shard in xrange(shards)]
+
+def queues(config):
+    """Return the queues jobs are read from, in lane priority order:  each
+    lane's queues, or with neither lanes nor shards, the one `queue`."""
+    return [queue for lane, queue, weight in lane_queues(config)]
+
+def route(config, lane=None, key=None):
+    """Return the queue a message in lane (or `default_lane`, or the last
+    lane) with a shard key is published to, or None if there are no lanes or
+    shards and messages go through the exchange.  Messages without a key go
+    to a random shard."""
+    names = [name for name, weight in lanes(config)]
+    shards = int(config.get("shards") or 1)
+    if names == [None] and shards == 1:
+        return None
+    if lane not in names:
+        lane = config.get("default_lane") if config.get("default_lane") in names else names[-1]
+    if key is None:
+        shard = random.randrange(shards)
+    else:
+        shard = (crc32(key) & 0xffffffff) % shards
+    return queue_name(config, lane, shard)
+
 def autoreconnect(func):
     @wraps(func)
     def wrapper(self, *a, **kw):
@@ -32,6 +225,200 @@ def autoreconnect(func):
         return ret
     return wrapper
 
+class SharedConnection(object):
+    """One connection to the broker, shared by every Amqp client in the
+    process that connects to the same host and vhost as the same user (see
+    `shared_connection`).  Clients each have channels of their own on it, and
+    the exchange and queues are declared once per connection rather than by
+    every client.
+
+    amqplib isn't safe for concurrent use, so every call on a channel is
+    made holding the connection's lock (see `SharedChannel`).  A reader
+    greenlet reads from the connection whenever it's readable and nobody
+    waiting on a reply has read it first, and whatever a call reads for
+    other channels while waiting on its reply is dispatched once it has it.
+    Deliveries are handed to consumers' callbacks by a greenlet per channel,
+    so a callback that blocks (eg. a full Consumer) never holds up the
+    connection.
+
+    When the connection fails, its `closed` result is set to the error and
+    the next client to reconnect opens a new one, which the others then take
+    channels on;  a broker restart costs a process one connect, not one per
+    client."""
+    def __init__(self, config):
+        self.config = config
+        self.lock = RLock()
+        self.connection = None
+        self.closed = None
+        self.reader = None
+        # (exchange, queues, bound) declared on the current connection
+        self.declared = set()
+        self.stats = {"connects": 0, "channels": 0, "errors": 0}
+
+    def connect(self):
+        """Return the connection, opening one if there's none open."""
+        with self.lock:
+            if self.connection is None:
+                c = self.config
+                self.connection = Connection(
+                    host=c["host"],
+                    virtual_host=c["vhost"],
+                    userid=c["username"],
+                    password=c["password"]
+                )
+                self.closed = AsyncResult()
+                self.declared.clear()
+                self.stats["connects"] += 1
+                self.reader = gevent.spawn(self.read, self.connection)
+            return self.connection
+
+    def channel(self, prefetch):
+        """Open a channel with a prefetch count of its own."""
+        with self.lock:
+            connection = self.connect()
+            channel = SharedChannel(self, connection, self.call(connection, connection.channel))
+            self.stats["channels"] += 1
+            channel.basic_qos(0, int(prefetch), False)
+            return channel
+
+    def declare(self, channel, config):
+        """Declare the exchange and a client's queues on channel, unless
+        they have been already on this connection."""
+        bound = not route(config)
+        key = (config["exchange"], tuple(queues(config)), bound)
+        with self.lock:
+            if key in self.declared:
+                return
+            qa = dict(durable=False, auto_delete=False)
+            channel.exchange_declare(config["exchange"], type="fanout", **qa)
+            # with lanes or shards, jobs are published straight to their
+            # queues, and nothing reads the one `queue`, so it isn't bound
+            for name in key[1]:
+                channel.queue_declare(queue=name, exclusive=False, **qa)
+            if bound:
+                channel.queue_bind(queue=config["queue"], exchange=config["exchange"])
+            self.declared.add(key)
+
+    def call(self, connection, method, *a, **kw):
+        """Call a method of a channel on connection holding the lock, and
+        dispatch anything read for other channels while it waited.  Errors
+        from the connection, rather than the channel, close it."""
+        with self.lock:
+            if connection is not self.connection:
+                raise IOError("AMQP connection closed")
+            try:
+                result = method(*a, **kw)
+                self.pump()
+                return result
+            except (IOError, amqp.AMQPConnectionException), e:
+                self.fail(connection, e)
+                raise
+
+    def pump(self):
+        """Dispatch the methods that were read for channels while another
+        waited on a reply, and any more that were read along with it.
+        Called holding the lock."""
+        connection = self.connection
+        while (getattr(connection.transport, "_read_buffer", None) or
+                any(channel.method_queue for channel in connection.channels.values())):
+            connection.drain_events(timeout=1)
+
+    def read(self, connection):
+        sock = connection.transport.sock
+        while connection is self.connection:
+            try:
+                wait_read(sock.fileno())
+                with self.lock:
+                    if connection is not self.connection:
+                        break
+                    if select.select([sock], [], [], 0)[0]:
+                        connection.drain_events(timeout=1)
+                    self.pump()
+            except socket.timeout:
+                continue
+            except Exception, e:
+                self.fail(connection, e)
+
+    def fail(self, connection, error):
+        """Close a connection that has failed, and wake whoever waits on it
+        with the error."""
+        with self.lock:
+            if connection is not self.connection:
+                return
+            logger.error("AMQP connection failed: %s" % error)
+            self.stats["errors"] += 1
+            self.connection = None
+            self.closed.set_exception(error)
+            if self.reader is not getcurrent():
+                self.reader.kill(block=False)
+            try:
+                connection.transport.close()
+            except Exception:
+                pass
+
+class SharedChannel(object):
+    """A channel on a SharedConnection.  Its methods are those of the
+    amqplib channel, called holding the connection's lock, and consumers'
+    callbacks are called from a greenlet of its own.  `closed` is the
+    connection's, so waiting on it raises the error the connection fails
+    with."""
+    def __init__(self, shared, connection, channel):
+        self.shared = shared
+        self.connection = connection
+        self.channel = channel
+        self.closed = shared.closed
+        self.deliveries = None
+        self.dispatcher = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.channel, name)
+        if not callable(attr):
+            return attr
+        def call(*a, **kw):
+            return self.shared.call(self.connection, attr, *a, **kw)
+        return call
+
+    def basic_consume(self, queue, callback=None, **kw):
+        if callback is not None:
+            callback = self.deliverer(callback)
+        return self.shared.call(self.connection, self.channel.basic_consume, queue,
+            callback=callback, **kw)
+
+    def deliverer(self, callback):
+        if self.dispatcher is None:
+            self.deliveries = queue.Queue()
+            self.dispatcher = gevent.spawn(self.dispatch)
+        def deliver(message):
+            self.deliveries.put((callback, message))
+        return deliver
+
+    def dispatch(self):
+        while 1:
+            callback, message = self.deliveries.get()
+            try:
+                callback(message)
+            except Exception:
+                logger.exception("Error in amqp consumer callback")
+
+    def close(self):
+        """Close the channel, if its connection is still open.  Deliveries
+        not yet dispatched are dropped;  the broker redelivers them."""
+        try:
+            self.shared.call(self.connection, self.channel.close)
+        except Exception:
+            pass
+        if self.dispatcher is not None and self.dispatcher is not getcurrent():
+            self.dispatcher.kill(block=False)
+
+# (host, vhost, username) -> the process's connection to that broker
+connections = {}
+
+def shared_connection(config):
+    key = (config["host"], config["vhost"], config["username"])
+    if key not in connections:
+        connections[key] = SharedConnection(config)
+    return connections[key]
+
 class AmqpConnectionPool(ConnectionPool):
     def __init__(self, config, maxsize=10):
         maxsize = int(config.get("poolsize", maxsize))
@@ -40,13 +427,13 @@ class AmqpConnectionPool(ConnectionPool):
 
     def new_connection(self):
         c = self.config
-        con = AmqpClient(**c)
+        con = Amqp(**c)
         return con
 
 class AmqpPool(object):
-    """A pooled Amqp client.  Multiple connections are made and passed out
-    on demand, so they cannot be used by two different greenlets at once.  It
-    might be better to use a single amqp connection with a Consumer."""
+    """A pooled Amqp client.  Up to `poolsize` clients, each with a channel
+    on the process's shared connection, are passed out on demand, so a
+    channel is never used by two different greenlets at once."""
     def __init__(self, **kw):
         config = merge(defaults, settings.like("amqp"), kw)
         required = ("port", "username", "password", "host", "vhost", "exchange", "queue")
@@ -54,14 +441,18 @@ class AmqpPool(object):
         self.__dict__.update(config)
         self.config = config
         self.pool = AmqpConnectionPool(config)
+        self.status_cache = QueueStatus(self)
 
     def reconnect(self):
         with self.pool.connection() as client:
             return client.reconnect()
 
-    def status(self, **kw):
+    def status(self, cached=True):
+        return dict(self.status_cache.get(cached), **rates())
+
+    def declare_status(self):
         with self.pool.connection() as client:
-            return client.status(**kw)
+            return client.declare_status()
 
     def publish(self, *a, **kw):
         with self.pool.connection() as client:
@@ -84,97 +475,403 @@ class AmqpPool(object):
             return client.cancel(*a, **kw)
 
 class Amqp(object):
+    """An Amqp client, with a channel on the process's shared connection
+    (see `SharedConnection`)."""
     def __init__(self, **kw):
         config = merge(defaults, settings.like("amqp"), kw)
         required = ("port", "username", "password", "host", "vhost", "exchange", "queue")
         require(self, config, required)
         self.__dict__.update(config)
         self.config = config
+        self.status_cache = QueueStatus(self)
+        self.shared = shared_connection(config)
+        self.channel = None
         self.reconnect()
 
     def reconnect(self):
-        self.connection = Connection(
-            host=self.host,
-            virtual_host=self.vhost,
-            userid=self.username,
-            password=self.password
-        )
-        qa = dict(durable=False, auto_delete=False)
-        self.channel = self.connection.channel()
-        self.channel.basic_qos(0, self.prefetch_count, False)
-        self.channel.queue_declare(queue=self.queue,exclusive=False, **qa)
-        self.channel.exchange_declare(self.exchange, type="fanout", **qa)
-        self.channel.queue_bind(queue=self.queue, exchange=self.exchange)
+        """Replace the client's channel with a new one, connecting again if
+        the connection has failed."""
+        if self.channel is not None:
+            self.channel.close()
+        self.channel = self.open_channel()
+        self.shared.declare(self.channel, self.config)
+
+    def open_channel(self, prefetch=None):
+        """Open another channel on the client's connection."""
+        return self.shared.channel(prefetch or self.prefetch_count)
 
-    @autoreconnect
     def status(self, cached=True):
-        status = self.channel.queue_declare(queue=self.queue, exclusive=False,
-                durable=False, auto_delete=False)
-        name, message_count, consumer_count = status
-        return dict(name=status[0], messages=status[1], consumers=status[2])
+        """Return the queue's status, from a snapshot up to `status_ttl`
+        seconds old unless cached is False, with this process's message
+        rates."""
+        return dict(self.status_cache.get(cached), **rates())
+
+    @autoreconnect
+    def declare_status(self):
+        """Read the queue's status, or the total of its lanes' and shards',
+        with passive declares."""
+        statuses = []
+        for queue in queues(self.config):
+            name, messages, consumers = self.channel.queue_declare(queue=queue, passive=True)
+            statuses.append(dict(name=name, messages=messages, consumers=consumers))
+        return combine_status(self.queue, statuses)
 
     @autoreconnect
-    def publish(self, message, exchange=None):
-        self.channel.basic_publish(amqp.Message(message), exchange or self.exchange)
+    def publish(self, message, exchange=None, lane=None, key=None):
+        """Publish a message to the exchange, or with lanes or shards, to the
+        queue for lane and key (see `route`)."""
+        queue = None if exchange else route(self.config, lane, key)
+        if queue is not None:
+            self.channel.basic_publish(amqp.Message(message), "", queue)
+        else:
+            self.channel.basic_publish(amqp.Message(message), exchange or self.exchange)
+        meters["published"].mark()
 
     @autoreconnect
     def get(self, queue=None):
         """Attempt to get something from a queue.  If queue is None, uses the
-        default queue for this client."""
-        m = self.channel.basic_get(queue or self.queue)
-        if m is not None:
-            self.channel.basic_ack(m.delivery_tag)
-        return m
-
-    def poll(self, queue=None, timeout=None, every=0.1):
-        """Poll every `every` seconds for a message on queue."""
-        start = time()
-        m = self.get(queue)
-        while m is None:
-            sleep(every)
-            now = time()
-            if timeout and now - start >= timeout:
+        default queue for this client, or with lanes or shards, tries their
+        queues in priority order."""
+        for name in [queue] if queue else queues(self.config):
+            m = self.channel.basic_get(name)
+            if m is not None:
+                self.channel.basic_ack(m.delivery_tag)
+                meters["delivered"].mark()
+                meters["acked"].mark()
                 return m
-            m = self.get(queue)
-        return m
+        return None
+
+    def poll(self, queue=None, timeout=None, every=None):
+        """Wait up to timeout seconds (forever if None) for a message on
+        queue (by default, as for `get`), returning it acked, or None.  The
+        message is pushed by the broker to a consumer with a prefetch of 1, so
+        waiting costs no broker traffic;  `every` is ignored, and kept for
+        compatibility.
+
+        The consumer is on a channel of its own, which is closed once a
+        message is taken:  when several queues are polled, more than one can
+        deliver at once, and closing the channel requeues the others'
+        messages, even those that come in after it stops consuming."""
+        messages = gevent.queue.Queue()
+        channel = self.open_channel(1)
+        try:
+            for name in [queue] if queue else queues(self.config):
+                self.consume(messages.put, name, no_ack=False, channel=channel)
+            try:
+                message = messages.get(timeout=timeout)
+            except gevent.queue.Empty:
+                return None
+            channel.basic_ack(message.delivery_tag)
+        finally:
+            channel.close()
+        meters["delivered"].mark()
+        meters["acked"].mark()
+        return message
 
-    def consume(self, callback, queue=None, no_ack=True):
-        """Start consuming messages from a channel.  Returns the channel.
-        Use AmqpClient.cancel() to cancel this consuming."""
-        self.tag = self.channel.basic_consume(queue or self.queue, callback=callback, no_ack=no_ack)
-        return self.channel
+    def drain(self, timeout=None):
+        """Wait until the client's connection fails, raising its error, or
+        for timeout seconds, raising socket.timeout.  Deliveries are read by
+        the connection's reader greenlet and handed to consumers as they
+        come in, so there is nothing else to wait for."""
+        try:
+            self.channel.closed.get(timeout=timeout)
+        except Timeout:
+            raise socket.timeout("timed out")
+
+    def ack(self, delivery_tag, multiple=False):
+        """Ack a delivery, or with multiple, it and every earlier delivery on
+        the channel."""
+        self.channel.basic_ack(delivery_tag, multiple)
+
+    def consume(self, callback, queue=None, no_ack=True, channel=None):
+        """Start consuming messages on a channel (by default, the client's).
+        Returns the channel.  Use AmqpClient.cancel() to cancel this
+        consuming."""
+        channel = channel or self.channel
+        self.tag = channel.basic_consume(queue or self.queue, callback=callback, no_ack=no_ack)
+        return channel
 
     def cancel(self, tag=None):
         """Cancel consuming."""
         self.channel.basic_cancel(tag or self.tag)
 
+class Publisher(object):
+    """A batching publisher.  Messages are buffered and sent when
+    `publish_batch_size` are waiting, `publish_interval` seconds after the
+    first was buffered, or on `flush()`.
+
+    With `publish_confirm`, each batch is published in a transaction, so once
+    flush returns the broker has it.  amqplib has no publisher confirms, so
+    transactions stand in for them.  If the connection fails partway through
+    a batch, the client reconnects and resends only the messages which
+    weren't confirmed:  the whole open transaction with confirms, and
+    everything from the failed message on without them.
+
+    Flushes are serialized, since the interval timer and callers can flush
+    at once.  The publisher should have a client of its own, as its channel
+    is in transaction mode with confirms and can't be shared with other
+    greenlets' requests;  clients share the process's connection, so this
+    costs a channel, not a connection."""
+    def __init__(self, client=None, **kw):
+        self.client = client if client else Amqp(**kw)
+        config = merge(defaults, settings.like("amqp"), kw)
+        self.batch_size = int(config["publish_batch_size"])
+        self.interval = float(config["publish_interval"])
+        confirm = config["publish_confirm"]
+        self.confirm = confirm not in (False, "False", "false", "0", 0)
+        self.buffer = []
+        self.timer = None
+        self.lock = RLock()
+        # the channel put into transaction mode, which a reconnect replaces
+        self.tx_channel = None
+        self.stats = {"published": 0, "batches": 0, "resent": 0, "errors": 0}
+
+    def publish(self, message, exchange=None, lane=None, key=None):
+        queue = None if exchange else route(self.client.config, lane, key)
+        self.buffer.append((message, exchange, queue))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = gevent.spawn_later(self.interval, self.flush)
+
+    def flush(self):
+        """Send every buffered message, returning how many were sent.  If a
+        batch can't be sent after reconnecting, its unsent messages are put
+        back in the buffer and the error is raised."""
+        with self.lock:
+            timer, self.timer = self.timer, None
+            if timer is not None and timer is not getcurrent():
+                timer.kill(block=False)
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return 0
+            pending = deque(batch)
+            for attempt in (0, 1):
+                try:
+                    self.send(pending)
+                    break
+                except Exception, e:
+                    self.stats["errors"] += 1
+                    logger.error("Error publishing batch of %d: %s" % (len(batch), e))
+                    if not attempt:
+                        try:
+                            self.client.reconnect()
+                            self.stats["resent"] += len(pending)
+                            continue
+                        except Exception, e:
+                            logger.error("Error reconnecting: %s" % e)
+                    self.buffer[:0] = pending
+                    raise
+            self.stats["published"] += len(batch)
+            meters["published"].mark(len(batch))
+            self.stats["batches"] += 1
+            return len(batch)
+
+    def send(self, pending):
+        """Publish a deque of pending messages on the client's channel, and
+        commit them when confirming.  Messages are taken off pending once
+        they are sent, or with confirms, once they are committed, so after an
+        error pending holds those that must be resent."""
+        channel = self.client.channel
+        if self.confirm:
+            if self.tx_channel is not channel:
+                channel.tx_select()
+                self.tx_channel = channel
+            for item in pending:
+                self.basic_publish(channel, item)
+            channel.tx_commit()
+            pending.clear()
+        else:
+            while pending:
+                self.basic_publish(channel, pending[0])
+                pending.popleft()
+
+    def basic_publish(self, channel, item):
+        message, exchange, queue = item
+        if queue is not None:
+            channel.basic_publish(amqp.Message(message), "", queue)
+        else:
+            channel.basic_publish(amqp.Message(message), exchange or self.client.exchange)
+
+class Lane(object):
+    """One queue consumed by a Consumer, with the local messages waiting
+    from it and the state for batching its acks.  Each lane has a channel of
+    its own, since acks with multiple=True cover a whole channel."""
+    def __init__(self, name, queue, weight=1):
+        self.name = name
+        self.queue = queue
+        self.weight = float(weight)
+        self.channel = None
+        self.tag = None
+        self.messages = deque()
+        # smooth weighted round robin counter
+        self.current = 0
+        self.reset()
+
+    def reset(self):
+        # delivery tags in delivery order, and those done but not yet acked
+        self.delivered = deque()
+        self.done = set()
+        self.ready = 0
+        self.last = None
+
 class Consumer(object):
     """A queue consumer.  This queue will consume a channel and fill up a local
     synchronized queue which can then be polled by many greenlets.  The consume
-    should be much lower impact than issuing a storm of failing gets."""
-    def __init__(self, client=None, size=100):
+    should be much lower impact than issuing a storm of failing gets.
+
+    With `amqp_lanes` or `amqp_shards` configured, each of their queues is
+    consumed, and `get` takes from them in proportion to the lanes' weights,
+    so a backlog in a low priority lane doesn't hold up a higher one.
+
+    Without no_ack, messages are acked in batches:  once `ack_every` messages
+    at the front of a queue's delivery order have been acked by the caller
+    (or whenever the local queue runs dry), a single ack with multiple=True
+    covers them all.  A message still running holds back the batched acks of
+    those delivered after it from the same queue, so once `ack_every` of
+    those are done they are acked one by one instead;  a slow job can't hold
+    more than a batch of acks, and so can't use up the prefetch window.  With
+    `prefetch`, each queue's prefetch count is set to it on consuming."""
+    def __init__(self, client=None, size=100, no_ack=True, prefetch=None, ack_every=None):
         self.greenlets = []
-        self.messages = queue.Queue(int(size))
         self.client = client if client else Amqp()
+        self.no_ack = no_ack
+        self.prefetch = prefetch
+        if ack_every is None:
+            ack_every = self.client.config.get("ack_every", defaults["ack_every"])
+        self.ack_every = int(ack_every)
+        self.lanes = [Lane(*q) for q in lane_queues(self.client.config)]
+        # counts messages waiting locally, and space for more
+        self.waiting = Semaphore(0)
+        self.space = Semaphore(int(size))
+        self.stats = {"delivered": 0, "acks": 0, "acked": 0, "dropped": 0}
+
+    def consume(self):
+        lanes = len(self.lanes) > 1 or self.lanes[0].name is not None
+        for lane in self.lanes:
+            # messages delivered before a reconnect can't be acked, and the
+            # broker redelivers them, so those not yet taken are dropped
+            while not self.no_ack and lane.messages and self.waiting.acquire(blocking=False):
+                lane.messages.pop()
+                self.space.release()
+                self.stats["dropped"] += 1
+            lane.reset()
+            if lane.channel is not None and lane.channel is not self.client.channel:
+                lane.channel.close()
+            # the client's own channel is used when there's just its queue
+            if not lanes:
+                lane.channel = self.client.channel
+            else:
+                lane.channel = self.client.open_channel()
+            if self.prefetch or lanes:
+                prefetch = self.prefetch or self.client.prefetch_count
+                lane.channel.basic_qos(0, int(prefetch), False)
+            lane.tag = lane.channel.basic_consume(lane.queue, callback=self.filler(lane),
+                no_ack=self.no_ack)
 
     def start(self):
-        channel = self.client.consume(callback=self.fill)
+        self.consume()
         while 1:
             try:
-                channel.wait()
+                self.client.drain()
             except Exception, e:
-                self.client.cancel()
                 logger.error("Error occured while waiting on channel: %s" % e)
+                try:
+                    self.stop()
+                except Exception:
+                    pass
                 self.client.reconnect()
-                channel = self.client.consume(callback=self.fill)
+                self.consume()
         logger.error("leaving impossible-to-leave loop")
 
     def stop(self):
         logger.debug("Stopping consumer")
-        self.client.cancel()
+        for lane in self.lanes:
+            if lane.tag is not None:
+                lane.channel.basic_cancel(lane.tag)
+                lane.tag = None
+
+    def filler(self, lane):
+        def fill(message):
+            self.fill(message, lane)
+        return fill
+
+    def fill(self, message, lane):
+        """Fill a local gevent-synced queue with items from a client.  This
+        blocks the consumer while the local queue is full."""
+        self.space.acquire()
+        self.stats["delivered"] += 1
+        meters["delivered"].mark()
+        message.lane = lane
+        message.consumer_channel = lane.channel
+        if not self.no_ack:
+            lane.delivered.append(message.delivery_tag)
+        lane.messages.append(message)
+        self.waiting.release()
 
-    def fill(self, message):
-        """Fill a local gevent-synced queue with items from a client."""
-        self.messages.put(message)
+    def get(self):
+        """Wait for a message, taking from the lanes with messages waiting in
+        proportion to their weights."""
+        self.waiting.acquire()
+        total, best = 0, None
+        for lane in self.lanes:
+            if lane.messages:
+                lane.current += lane.weight
+                total += lane.weight
+                if best is None or lane.current > best.current:
+                    best = lane
+        best.current -= total
+        self.space.release()
+        return best.messages.popleft()
 
+    def ack(self, message):
+        """Mark a message done when not consuming with no_ack.  Messages
+        delivered before a reconnect can't be acked;  the broker will
+        redeliver them."""
+        lane = getattr(message, "lane", None)
+        if self.no_ack or lane is None or message.consumer_channel is not lane.channel:
+            return
+        lane.done.add(message.delivery_tag)
+        while lane.delivered and lane.delivered[0] in lane.done:
+            lane.last = lane.delivered.popleft()
+            lane.done.discard(lane.last)
+            lane.ready += 1
+        if lane.ready and (lane.ready >= self.ack_every or not lane.messages):
+            self.flush(lane)
+        if len(lane.done) >= self.ack_every:
+            self.ack_done(lane)
+
+    def ack_done(self, lane):
+        """Ack every message that is done behind the one at the front of a
+        lane's delivery order, which is still running, one at a time."""
+        self.flush(lane)
+        for tag in sorted(lane.done):
+            try:
+                lane.channel.basic_ack(tag, False)
+                self.stats["acks"] += 1
+                self.stats["acked"] += 1
+                meters["acked"].mark()
+            except Exception, e:
+                logger.error("Error acking message %s: %s" % (tag, e))
+            lane.delivered.remove(tag)
+        lane.done.clear()
+
+    def flush(self, lane=None):
+        """Ack every message at the front of a lane's (or every lane's)
+        delivery order that is done."""
+        for lane in [lane] if lane is not None else self.lanes:
+            if not lane.ready:
+                continue
+            try:
+                lane.channel.basic_ack(lane.last, True)
+                self.stats["acks"] += 1
+                self.stats["acked"] += lane.ready
+                meters["acked"].mark(lane.ready)
+            except Exception, e:
+                logger.error("Error acking messages up to %s: %s" % (lane.last, e))
+            lane.ready = 0
 
+    def info(self):
+        """Return the consumer's stats, with the messages waiting locally in
+        each lane."""
+        return dict(self.stats, lanes=dict((lane.queue, len(lane.messages)) for lane in self.lanes))
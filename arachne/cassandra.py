@@ -5,7 +5,7 @@
 
 import pycassa
 
-from arachne import utils
+from arachne import utils, offload
 from arachne.conf import settings, merge, require
 
 defaults = {
@@ -22,8 +22,8 @@ encode = utils.encode
 def decode(data, colname=None):
     """Decode data coming out of storage."""
     if colname:
-        return utils.decode(data[colname])
-    return utils.decode(data)
+        return offload.decode(data[colname])
+    return offload.decode(data)
 
 
 class Cassandra(object):
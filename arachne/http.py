@@ -6,6 +6,11 @@
 import requests
 #import ujson as json
 import simplejson as json
+import struct
+import zlib
+import ssl
+import socket
+import httplib
 from time import time, mktime
 from contextlib import contextmanager
 from datetime import datetime
@@ -16,11 +21,13 @@ from urllib import urlencode, quote
 from urlparse import urljoin, parse_qs
 from hashlib import md5
 
-from arachne import memcached
+from arachne import memcached, offload, ratelimit
+from arachne.resolver import Resolver
 from arachne.conf import merge, settings, require
-from arachne.utils import encode, decode
+from arachne.utils import decode, LRUCache
 
 from humanize.filesize import naturalsize
+from gevent.event import AsyncResult
 
 # OAuth v1.0a support from requests-oauth
 from oauth_hook import OAuthHook
@@ -36,12 +43,31 @@ json_types = (
     'text/json',
 )
 
+json_lines_types = (
+    'application/x-ndjson',
+    'application/x-json-stream',
+    'application/jsonl',
+)
+
+xml_types = (
+    'application/xml',
+    'text/xml',
+    'application/rss+xml',
+    'application/atom+xml',
+)
+
 from requests import models
+from requests.structures import CaseInsensitiveDict
+from requests.packages.urllib3.poolmanager import PoolManager
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool, \
+    VerifiedHTTPSConnection, match_hostname
 
 class Response(models.Response):
     # requests adds a json property in 0.13, which means our way of doing json
     # (which, as we always need it, is probably better) was broken
     json = None
+    # True for responses served from the body cache
+    from_cache = False
 
     def iter_content(self, chunk_size=1, decode_unicode=False):
         """Request's default response object will read 10k bytes at a time.
@@ -51,6 +77,12 @@ class Response(models.Response):
         chunk_size = settings.get("transfer_chunk_size", 500*1024)
         return super(Response, self).iter_content(chunk_size, decode_unicode)
 
+    def iter_chunks(self, chunk_size=None):
+        """Iterate over the body in chunks of `stream_chunk_size`, which
+        should be much smaller than the chunks read for the whole content."""
+        chunk_size = chunk_size or settings.get("stream_chunk_size", 64*1024)
+        return super(Response, self).iter_content(chunk_size)
+
 if models.Response != Response:
     models.Response = Response
 
@@ -63,6 +95,9 @@ class HttpError(Exception):
 class CacheHit(Exception):
     pass
 
+class RateLimited(Exception):
+    pass
+
 # -- utils --
 
 def mdict2sdict(mdict):
@@ -86,14 +121,243 @@ def join(*parts):
         url = url + '/'
     return url
 
+# -- Connection pooling --
+
+pool_defaults = {
+    # number of hosts to keep pools for
+    "hosts": 500,
+    # keep-alive connections per host;  with block, also the most concurrent
+    # requests made to one host
+    "maxsize": 10,
+    "block": True,
+    # pools for hosts which haven't been used in this many seconds are closed
+    "idle_timeout": 120,
+}
+
+class StatsMixin(object):
+    """Counts how often and for how long getting a connection had to wait
+    for one to be returned to the pool."""
+    waits = 0
+    wait_time = 0.0
+
+    def _get_conn(self, timeout=None):
+        if not self.pool.empty():
+            return super(StatsMixin, self)._get_conn(timeout)
+        t0 = time()
+        try:
+            return super(StatsMixin, self)._get_conn(timeout)
+        finally:
+            self.waits += 1
+            self.wait_time += time() - t0
+
+resolver = Resolver()
+
+def create_connection(host, port, timeout):
+    """Open a socket to host, resolving it through the dns cache unless
+    `disable_dns_cache` is set."""
+    if settings.get("disable_dns_cache", False):
+        return socket.create_connection((host, port), timeout)
+    return resolver.create_connection((host, port), timeout)
+
+class ResolvingHTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        self.sock = create_connection(self.host, self.port, self.timeout)
+
+class ResolvingHTTPSConnection(VerifiedHTTPSConnection):
+    def connect(self):
+        sock = create_connection(self.host, self.port, self.timeout)
+        self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file,
+            cert_reqs=self.cert_reqs, ca_certs=self.ca_certs)
+        if self.ca_certs:
+            match_hostname(self.sock.getpeercert(), self.host)
+
+class HTTPPool(StatsMixin, HTTPConnectionPool):
+    def _new_conn(self):
+        self.num_connections += 1
+        return ResolvingHTTPConnection(host=self.host, port=self.port)
+
+class HTTPSPool(StatsMixin, HTTPSConnectionPool):
+    def _new_conn(self):
+        self.num_connections += 1
+        connection = ResolvingHTTPSConnection(host=self.host, port=self.port)
+        connection.set_cert(key_file=self.key_file, cert_file=self.cert_file,
+            cert_reqs=self.cert_reqs, ca_certs=self.ca_certs)
+        return connection
+
+class SharedPoolManager(PoolManager):
+    """A PoolManager shared by every session, so that keep-alive connections
+    to a host are reused across plugins, Getters and OAuth clients.  Pools are
+    greenlet-safe when gevent has patched the standard library."""
+    pool_classes = {"http": HTTPPool, "https": HTTPSPool}
+    default_ports = {"http": 80, "https": 443}
+
+    def __init__(self, **kw):
+        config = merge(pool_defaults, settings.like("http_pool"), kw)
+        self.config = config
+        self.idle_timeout = float(config["idle_timeout"])
+        PoolManager.__init__(self, num_pools=int(config["hosts"]),
+            maxsize=int(config["maxsize"]), block=bool(config["block"]))
+        self.hosts = {}
+        self.last_used = {}
+        self.last_reap = time()
+
+    def connection_from_host(self, host, port=None, scheme='http'):
+        port = port or self.default_ports.get(scheme, 80)
+        key = (scheme, host, port)
+        now = time()
+        self.last_used[key] = now
+        if now - self.last_reap > self.idle_timeout / 2:
+            self.reap(now)
+        pool = self.pools.get(key)
+        if pool is None:
+            kw = self.connection_pool_kw.copy()
+            if scheme == 'http':
+                for k in ('key_file', 'cert_file', 'cert_reqs', 'ca_certs'):
+                    kw.pop(k, None)
+            pool = self.pool_classes[scheme](host, port, **kw)
+            self.pools[key] = pool
+            self.hosts[key] = pool
+        return pool
+
+    def reap(self, now=None):
+        """Close the connections of hosts which have been idle for longer
+        than `idle_timeout` and forget their pools."""
+        now = now or time()
+        self.last_reap = now
+        for key, used in self.last_used.items():
+            if now - used < self.idle_timeout:
+                continue
+            del self.last_used[key]
+            pool = self.hosts.pop(key, None)
+            if key in self.pools:
+                del self.pools[key]
+            while pool is not None and not pool.pool.empty():
+                conn = pool.pool.get(block=False)
+                if conn is not None:
+                    conn.close()
+
+    def stats(self, hosts=False):
+        """Return request, connection and pool wait counts, in total and
+        optionally per host.  A reuse ratio near 1 means nearly every request
+        went over an existing connection."""
+        def summarize(pools):
+            requests = sum(p.num_requests for p in pools)
+            connections = sum(p.num_connections for p in pools)
+            return {
+                "requests": requests,
+                "connections": connections,
+                "reuse_ratio": 1 - float(connections) / requests if requests else 0.0,
+                "waits": sum(p.waits for p in pools),
+                "wait_time": sum(p.wait_time for p in pools),
+            }
+        stats = summarize(self.hosts.values())
+        stats["hosts"] = len(self.hosts)
+        if hosts:
+            stats["per_host"] = dict(("%s://%s:%s" % key, summarize([pool]))
+                for key, pool in self.hosts.items())
+        return stats
+
+pool_manager = SharedPoolManager()
+
+def session(**kw):
+    """Return a requests session which uses the shared connection pools."""
+    client = requests.session(**kw)
+    client.poolmanager = pool_manager
+    return client
+
+def pooled(name):
+    """Return a function like requests.get (for name "get") which uses the
+    shared connection pools.  Each call gets a new session, so cookies are not
+    shared between calls just as with requests.get."""
+    def request(url, **kw):
+        return getattr(session(), name)(url, **kw)
+    request.__name__ = name
+    return request
+
+# -- Request coalescing --
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key:  while one call for a
+    key is in flight, other callers wait for and share its result (or its
+    exception) instead of making their own.  If the call is killed or times
+    out, they get a RuntimeError instead."""
+    def __init__(self):
+        self.flights = {}
+        self.stats = {"requests": 0, "coalesced": 0}
+
+    def do(self, key, func, *a, **kw):
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+            return flight.get()
+        self.stats["requests"] += 1
+        flight = self.flights[key] = AsyncResult()
+        try:
+            result = func(*a, **kw)
+        except Exception, e:
+            flight.set_exception(e)
+            raise
+        except:
+            # the leader was killed or timed out;  the waiters still have to
+            # wake, but a GreenletExit or Timeout isn't theirs to raise
+            flight.set_exception(RuntimeError("coalesced request aborted"))
+            raise
+        else:
+            flight.set(result)
+            return result
+        finally:
+            del self.flights[key]
+
+flights = SingleFlight()
+
+def coalesced_get(getfunc, identity, url, *a, **kw):
+    """Make a get with getfunc, sharing the response with any concurrent get
+    of the same url and params by the same identity.  Streaming gets are not
+    coalesced."""
+    if kw.get('stream'):
+        return getfunc(url, *a, **kw)
+    key = (requests_url(url, **kw), identity, sorted(kw.get('headers', {}).items()),
+        kw.get('json', False), kw.get('ignore_errors', True), kw.get('cache', True))
+    return flights.do(repr(key), getfunc, url, *a, **kw)
+
+# -- Rate limiting --
+
+def rate_limited(func, resource, timeout=None):
+    """Wrap a get or post (one wrapped by `wrapget`) so that its requests
+    wait for a token from the resource's rate limiter first (raising
+    RateLimited if none comes within timeout seconds), and let the limiter
+    adapt to the rate limit headers of the responses.  The token is taken
+    by `cache_manager` right before the request is made, so responses served
+    from the cache don't spend one."""
+    @wraps(func)
+    def wrapper(*a, **kw):
+        kw['ratelimit'] = (resource, timeout)
+        return func(*a, **kw)
+    return wrapper
+
+def limited_request(func, limit, *a, **kw):
+    """Make a request with func, first taking a token for limit, a
+    (resource, timeout) pair, if it isn't None."""
+    if limit is None:
+        return func(*a, **kw)
+    resource, timeout = limit
+    limiter = ratelimit.limiter(resource)
+    if not limiter.acquire(timeout):
+        raise RateLimited("No %s token within %ss" % (resource, timeout))
+    response = func(*a, **kw)
+    limiter.observe(response.status_code, response.headers)
+    return response
+
 # -- Oauth --
 
 def oauth_client(token, secret, consumer_key, consumer_secret, header_auth=True):
     """An OAuth client that can issue get requests."""
     hook = OAuthHook(token, secret, consumer_key, consumer_secret, header_auth)
-    client = requests.session(hooks={'pre_request': hook})
-    client.get = wrapget(client.get)
-    client.post = wrapget(client.post)
+    client = session(hooks={'pre_request': hook})
+    # signed responses are for this token only, so bodies are cached per token
+    identity = (consumer_key, token)
+    client.get = wrapget(client.get, identity)
+    client.post = wrapget(client.post, identity)
     return client
 
 # -- HTTP Get wrappers --
@@ -113,7 +377,7 @@ class OAuthTokenGetter(object):
         """Request an unauthorized token at the request token url.  kws passed
         to requests.get"""
         hook = OAuthHook(**self.client_params)
-        client = requests.session(hooks={'pre_request': hook})
+        client = session(hooks={'pre_request': hook})
         response = client.get(url, **kw)
         data = cgi_clean(response.text)
         return dict(secret=data["oauth_token_secret"], key=data["oauth_token"])
@@ -135,50 +399,74 @@ class OAuthTokenGetter(object):
 
 
 class OAuthGetter(object):
-    """A getter that will sign requests with OAuth v1.0a headers/url params."""
+    """A getter that will sign requests with OAuth v1.0a headers/url params.
+    With a resource, requests wait on its rate limiter (see Getter)."""
     def __init__(self, base_url, token, secret, key, key_secret,
-            header_auth=True, params={}, headers={}):
+            header_auth=True, params={}, headers={}, coalesce=False,
+            resource=None, ratelimit_timeout=None):
         self.client = oauth_client(token, secret, key, key_secret, header_auth)
         self.base_url = base_url
         self.default_params = params.copy()
         self.default_headers = headers.copy()
+        self.coalesce = coalesce
+        self.identity = (key, token)
+        self._get, self._post = self.client.get, self.client.post
+        if resource:
+            self._get = rate_limited(self._get, resource, ratelimit_timeout)
+            self._post = rate_limited(self._post, resource, ratelimit_timeout)
 
     def get(self, url, *a, **kw):
         url = join(self.base_url, url)
         kw['params'] = merge(self.default_params, kw.get('params', {}))
         kw['headers'] = merge(self.default_headers, kw.get('headers', {}))
-        return self.client.get(url, *a, **kw)
+        if self.coalesce:
+            return coalesced_get(self._get, self.identity, url, *a, **kw)
+        return self._get(url, *a, **kw)
 
     def post(self, url, *a, **kw):
         url = join(self.base_url, url)
         kw['params'] = merge(self.default_params, kw.get('params', {}))
         kw['headers'] = merge(self.default_headers, kw.get('headers', {}))
-        return self.client.post(url, *a, **kw)
+        return self._post(url, *a, **kw)
 
     @classmethod
-    def partial(cls, url, key, key_secret, header_auth=True, params={}, headers={}):
+    def partial(cls, url, key, key_secret, header_auth=True, params={}, headers={},
+            coalesce=False, resource=None, ratelimit_timeout=None):
         """Returns a method that will build an OAuthGetter based on the parameters."""
         def closure(token, secret):
             return OAuthGetter(url, token, secret, key, key_secret,
-                header_auth=header_auth, params=params, headers=headers)
+                header_auth=header_auth, params=params, headers=headers,
+                coalesce=coalesce, resource=resource, ratelimit_timeout=ratelimit_timeout)
         return closure
 
 class Getter(object):
     """A simple getter that uses the basic 'get' but stores default base
-    url, params, and headers.  Very similar to request's sessions."""
-    def __init__(self, base_url, params={}, headers={}, data={}, ignore_errors=False):
+    url, params, and headers.  Very similar to request's sessions.  With
+    coalesce, concurrent gets of the same url, params and headers share one
+    request.  With a resource, each request first waits (for at most
+    ratelimit_timeout seconds) on that resource's rate limiter, which backs
+    off according to the rate limit headers of the responses."""
+    def __init__(self, base_url, params={}, headers={}, data={}, ignore_errors=False,
+            coalesce=False, resource=None, ratelimit_timeout=None):
         self.base_url = base_url
         self.default_params = params.copy()
         self.default_headers = headers.copy()
         self.default_data = data.copy()
         self.ignore_errors = ignore_errors
+        self.coalesce = coalesce
+        self._get, self._post = get, post
+        if resource:
+            self._get = rate_limited(get, resource, ratelimit_timeout)
+            self._post = rate_limited(post, resource, ratelimit_timeout)
 
     def get(self, url, *a, **kw):
         url = join(self.base_url, url)
         kw['params'] = merge(self.default_params, kw.get('params', {}))
         kw['headers'] = merge(self.default_headers, kw.get('headers', {}))
         kw['ignore_errors'] = self.ignore_errors
-        return get(url, *a, **kw)
+        if self.coalesce:
+            return coalesced_get(self._get, None, url, *a, **kw)
+        return self._get(url, *a, **kw)
 
     def post(self, url, *a, **kw):
         url = join(self.base_url, url)
@@ -186,29 +474,39 @@ class Getter(object):
         kw['headers'] = merge(self.default_headers, kw.get('headers', {}))
         kw['data'] = merge(self.default_data, kw.get('data', {}))
         kw['ignore_errors'] = self.ignore_errors
-        return post(url, *a, **kw)
+        return self._post(url, *a, **kw)
 
 
-def wrapget(func):
-    """Wrap requests' `get` function with utility, convenience, book-keeping."""
+def wrapget(func, identity=None):
+    """Wrap requests' `get` function with utility, convenience, book-keeping.
+    Responses are cached for the identity (see `cache_manager`)."""
     # wrap with cache manager
-    func = cache_manager(func)
+    func = cache_manager(func, identity)
 
     @wraps(func)
     def wrapped(*a, **kw):
         """This adds a few things to get.  First, it can raise exceptions on
         errored status codes in the 400's and 500's, which can clean up a lot
         of plugin code that would otherwise have to check for that.  It also
-        auto-loads json content and puts it on response.json."""
+        auto-loads json content and puts it on response.json.  With `stream`,
+        the body is not loaded;  an ItemStream over it is returned instead."""
         ignore_errors = kw.pop('ignore_errors', True)
         is_json = kw.pop('json', False)
+        stream = kw.pop('stream', False)
+        if stream:
+            kw['prefetch'] = False
+            kw['cache_body'] = False
 
         response = func(*a, **kw)
+        if stream:
+            if response.status_code > 400 and not ignore_errors:
+                raise HttpError(response)
+            return ItemStream(response, stream)
         # pre-load the content with a read
         content = response.content
         # parse json
         if response.headers['content-type'].split(';')[0] in json_types or is_json:
-            response.json = json.loads(response.content) if response.content else {}
+            response.json = offload.loads(response.content) if response.content else {}
         # if an error occured and we waned to raise an exception, do it;  we
         # can still take the response off of this error
         if response.status_code > 400 and not ignore_errors:
@@ -217,33 +515,197 @@ def wrapget(func):
         return response
     return wrapped
 
+# -- Streaming --
+
+class ItemStream(object):
+    """An iterator over the items in a response body, which is read and
+    parsed incrementally so that only one item (and one chunk) need be held
+    in memory at a time.  The format is detected from the content type unless
+    one of "json", "lines" or "xml" is given:
+
+        * json: each element of a top level array;  other documents are
+          yielded whole
+        * lines: each non-empty line, parsed as json
+        * xml: each child element of the root element
+
+    Bodies of any other content type are yielded as raw chunks.  The response
+    is available as `.response`."""
+    def __init__(self, response, format=True):
+        self.response = response
+        if format is True:
+            content_type = response.headers.get('content-type', '').split(';')[0]
+            if content_type in json_types:
+                format = "json"
+            elif content_type in json_lines_types:
+                format = "lines"
+            elif content_type in xml_types:
+                format = "xml"
+        parsers = {"json": iter_json, "lines": iter_json_lines, "xml": iter_xml}
+        chunks = response.iter_chunks()
+        self.items = parsers[format](chunks) if format in parsers else chunks
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.items)
+
+whitespace = ' \t\r\n'
+
+def iter_json(chunks):
+    """Incrementally parse a json document from an iterator of chunks,
+    yielding each element of a top level array."""
+    decoder = json.JSONDecoder()
+    buf, pos, more = '', 0, True
+
+    def fill():
+        # read another chunk, dropping what has already been parsed
+        try:
+            return buf[pos:] + next(chunks), 0, True
+        except StopIteration:
+            return buf, pos, False
+
+    while True:
+        while pos < len(buf) and buf[pos] in whitespace:
+            pos += 1
+        if pos < len(buf) or not more:
+            break
+        buf, pos, more = fill()
+    if pos == len(buf):
+        return
+    if buf[pos] != '[':
+        # not an array;  read the whole thing
+        yield json.loads(buf[pos:] + ''.join(chunks))
+        return
+    pos += 1
+    while True:
+        while pos < len(buf) and buf[pos] in whitespace + ',':
+            pos += 1
+        if pos == len(buf):
+            if not more:
+                raise ValueError("Unterminated json array")
+            buf, pos, more = fill()
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # probably an incomplete item;  a real error is raised once there
+            # is nothing more to read
+            if not more:
+                raise
+            buf, pos, more = fill()
+            continue
+        if end == len(buf) or buf[end] not in whitespace + ',]':
+            # a number cut off by the end of a chunk ("1." or "1e" of "1.5e3")
+            # decodes up to the cut, which can only be followed by more of it
+            if more:
+                buf, pos, more = fill()
+                continue
+            if end < len(buf):
+                raise ValueError("Invalid json at %d: %r" % (end, buf[end:end + 20]))
+        pos = end
+        yield item
+
+def iter_json_lines(chunks):
+    """Parse line delimited json from an iterator of chunks."""
+    buf = ''
+    for chunk in chunks:
+        lines = (buf + chunk).split('\n')
+        buf = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buf.strip():
+        yield json.loads(buf)
+
+class ChunkReader(object):
+    """A minimal file-like object over an iterator of chunks."""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+def iter_xml(chunks):
+    """Incrementally parse an xml document from an iterator of chunks,
+    yielding each child of the root element once it is complete.  Yielded
+    elements are cleared from the tree after the consumer is done with them."""
+    from xml.etree import cElementTree as etree
+    depth, root = 0, None
+    for event, elem in etree.iterparse(ChunkReader(chunks), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield elem
+            root.clear()
+
 # -- Header/Cache management --
 
-def cache_manager(func):
-    """Another decorator for requests.get which manages the header cache."""
+def cache_manager(func, identity=None):
+    """Another decorator for requests.get which manages the header cache.
+    When the body cache is enabled, cache hits on gets are served from it
+    rather than raising CacheHit.  Requests that miss the cache wait on the
+    rate limiter given as `ratelimit` (see `rate_limited`).  Bodies are cached under the identity the
+    requests are made by (eg. an oauth token) as well as the url, since the
+    same url can return different bodies to different users."""
+    # only bodies from gets are cached
+    is_get = func.__name__ == "get"
+
     @wraps(func)
     def wrapper(*a, **kw):
+        cache_body = kw.pop('cache_body', True) and is_get and settings.enable_body_cache
+        limit = kw.pop('ratelimit', None)
         # allow the caller to set nocache
         if not kw.pop('cache', True):
-            return func(*a, **kw)
+            return limited_request(func, limit, *a, **kw)
 
         url = requests_url(*a, **kw)
+        cached = None
         if settings.enable_header_cache:
-            ch = header_cache.get(url)
+            if cache_body:
+                ch, cached = header_cache.get_with_body(url, body_cache, identity)
+                # without the body, a cache hit would leave us with nothing;
+                # with it, the validators are taken from its own record, as
+                # the header is kept per url and rewritten without the body
+                # (eg. when it's too large, or for another identity)
+                ch = cache_headers(cached.headers) if cached is not None else {}
+            else:
+                ch = header_cache.get(url)
             if ch:
                 if "expires" in ch and ch["expires"] > utcnow():
+                    if cached is not None:
+                        return cached
                     raise CacheHit("Expires in the future.")
                 kw.setdefault("headers", {}).update(ch)
 
-        response = func(*a, **kw)
+        response = limited_request(func, limit, *a, **kw)
 
         if response.status_code == 304:
+            if cached is not None:
+                return cached
             raise CacheHit("304 status code.")
         # set cache control headers if available
         if settings.enable_header_cache:
             ch = cache_headers(response.headers)
             if ch:
-                header_cache.set(url, cache_headers(response.headers))
+                header_cache.set(url, ch)
+                if cache_body and response.status_code == 200:
+                    body_cache.set(url, response, ch, identity)
         return response
     return wrapper
 
@@ -277,6 +739,43 @@ def cache_headers(headers):
 
     return header
 
+# header records are a version byte, which can't be confused with the leading
+# 'x' of the zlib compressed json records written by earlier versions, then
+# the expires time (0 for none) and the length prefixed validators
+header_record = struct.Struct("!BIH")
+header_version = 1
+field_length = struct.Struct("!H")
+
+def encode_header(header):
+    """Encode cache headers into a compact binary record."""
+    etag = header.get("if-none-match", "")
+    modified = header.get("if-modified-since", "")
+    if isinstance(etag, unicode):
+        etag = etag.encode("utf-8")
+    if isinstance(modified, unicode):
+        modified = modified.encode("utf-8")
+    return ''.join([
+        header_record.pack(header_version, int(header.get("expires", 0)), len(etag)),
+        etag, field_length.pack(len(modified)), modified])
+
+def decode_header(data):
+    """Decode a record made with encode_header, or an older json record."""
+    if ord(data[0]) != header_version:
+        return decode(data)
+    version, expires, length = header_record.unpack_from(data)
+    offset = header_record.size
+    header = {}
+    if expires:
+        header["expires"] = float(expires)
+    if length:
+        header["if-none-match"] = data[offset:offset + length]
+    offset += length
+    length, = field_length.unpack_from(data, offset)
+    offset += field_length.size
+    if length:
+        header["if-modified-since"] = data[offset:offset + length]
+    return header
+
 def disable_header_cache():
     """Utility function to disable the header cache."""
     global header_cache
@@ -289,34 +788,184 @@ def enable_header_cache(**kw):
     settings.enable_header_cache = True
     header_cache = HeaderCache(**kw)
 
+def disable_body_cache():
+    """Utility function to disable the body cache."""
+    global body_cache
+    settings.enable_body_cache = False
+    body_cache = DummyBodyCache()
+
+def enable_body_cache(**kw):
+    """Utility function to enable the body cache with arguments.  The body
+    cache is only used along with the header cache."""
+    global body_cache
+    settings.enable_body_cache = True
+    body_cache = BodyCache(**kw)
+
+def header_size(header):
+    """Approximate the memory used by a cache header dictionary."""
+    return sum(len(str(k)) + len(str(v)) for k,v in header.iteritems())
+
 class HeaderCache(object):
-    """Keeps a cache of url headers."""
+    """Keeps a cache of url headers.  Recently used headers are also kept in
+    a local LRU cache of up to `header_cache_local_size` entries and
+    `header_cache_local_bytes` bytes for `header_cache_local_ttl` seconds (or
+    until they expire), so that frequently polled urls don't go to memcached
+    on every request.  A local size of 0 disables the local cache."""
     def __init__(self, **kw):
         # use specialized cache if available, else default cache location
         self.config = merge(settings.like("memcached"), settings.like("header_cache"), kw)
         self.client = memcached.Memcached(**self.config)
+        local = lambda key, default: int(self.config.get("local_" + key,
+            settings.get("header_cache_local_" + key, default)))
+        size = local("size", 10000)
+        self.local = LRUCache(size, local("bytes", 10*1024*1024), local("ttl", 300),
+            sizeof=header_size) if size else None
 
     def get(self, url):
-        result = self.client.get('hc-%s' % md5(url).hexdigest())
-        return decode(result) if result else {}
+        key = 'hc-%s' % md5(url).hexdigest()
+        if self.local is not None:
+            header = self.local.get(key)
+            if header is not None:
+                return header
+        return self.remember(key, self.client.get(key))
+
+    def remember(self, key, result):
+        """Decode a header fetched from memcached, keeping it locally."""
+        header = decode_header(result) if result else {}
+        if header and self.local is not None:
+            self.local.set(key, header, self.local_ttl(header))
+        return header
+
+    def get_with_body(self, url, body_cache, identity=None):
+        """Return the header and the cached body Response (or None) for url
+        as requested by identity.  When the header isn't held locally and the
+        body cache uses the same servers, both are fetched from memcached in
+        one request."""
+        key = 'hc-%s' % md5(url).hexdigest()
+        if self.local is not None:
+            header = self.local.get(key)
+            if header is not None:
+                return header, (body_cache.get(url, identity) if header else None)
+        client = getattr(body_cache, "client", None)
+        if client is None or client.servers != self.client.servers:
+            header = self.get(url)
+            return header, (body_cache.get(url, identity) if header else None)
+        body_key = body_cache.key(url, identity)
+        results = self.client.get_multi(key, body_key)
+        header = self.remember(key, results.get(key))
+        return header, body_cache.response(url, results.get(body_key))
+
+    def local_ttl(self, header):
+        """Don't keep headers with an expires time locally any longer than
+        they would be valid."""
+        if "expires" in header:
+            return max(min(self.local.ttl, header["expires"] - utcnow()), 0.001)
+        return None
 
     def set(self, url, header):
         key = 'hc-%s' % md5(url).hexdigest()
+        if self.local is not None:
+            self.local.set(key, header, self.local_ttl(header))
+        data = encode_header(header)
         if "expires" in header:
-            self.client.set(key, encode(header), header["expires"] - utcnow())
-        self.client.set(key, encode(header))
+            # memcached reads expiration times over 30 days as timestamps
+            ttl = min(max(int(header["expires"] - utcnow()), 1), 30*86400)
+            self.client.set(key, data, ttl, noreply=True)
+        else:
+            self.client.set(key, data, noreply=True)
 
 class DummyHeaderCache(HeaderCache):
     def __init__(self, **kw): pass
     def get(self, url): return {}
+    def get_with_body(self, url, body_cache, identity=None): return {}, None
     def set(self, url, header): return
 
+# headers kept with cached bodies
+body_headers = ('content-type', 'etag', 'last-modified', 'expires')
+body_record = struct.Struct("!HI")
+
+def encode_body(response, level=6):
+    """Encode a response's status, some headers and content into a
+    compressed record."""
+    headers = json.dumps(dict((k, response.headers[k]) for k in body_headers
+        if response.headers.get(k)))
+    record = body_record.pack(response.status_code, len(headers))
+    return zlib.compress(record + headers + response.content, level)
+
+def decode_body(data):
+    """Decode a body record into (status_code, headers, content)."""
+    data = zlib.decompress(data)
+    status_code, length = body_record.unpack_from(data)
+    offset = body_record.size
+    headers = json.loads(data[offset:offset + length])
+    return status_code, headers, data[offset + length:]
+
+class BodyCache(object):
+    """Keeps compressed response bodies alongside the header cache, so that
+    a 304 or an unexpired response can be served in full.  Bodies which are
+    larger than `body_cache_max_size` compressed are not kept;  cached bodies
+    expire after `body_cache_ttl` seconds or when their expires time passes,
+    and are otherwise evicted by memcached as it needs the space."""
+    def __init__(self, **kw):
+        self.config = merge(settings.like("memcached"), settings.like("body_cache"), kw)
+        self.client = memcached.Memcached(**self.config)
+        option = lambda key, default: int(self.config.get(key,
+            settings.get("body_cache_" + key, default)))
+        # memcached's default item size limit is 1MB
+        self.max_size = option("max_size", 1000*1000)
+        self.ttl = option("ttl", 86400)
+        self.level = option("level", 6)
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "too_large": 0}
+
+    def key(self, url, identity=None):
+        if identity is not None:
+            url = "%s %s" % (":".join(identity), url)
+        return 'bc-%s' % md5(url).hexdigest()
+
+    def get(self, url, identity=None):
+        """Return a Response for the body of url cached for identity, or
+        None."""
+        return self.response(url, self.client.get(self.key(url, identity)))
+
+    def response(self, url, result):
+        """Return a Response for a body record fetched for url, or None."""
+        if not result:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        status_code, headers, content = offload.call(decode_body, result)
+        response = Response()
+        response.url = url
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    def set(self, url, response, header, identity=None):
+        data = encode_body(response, self.level)
+        if len(data) > self.max_size:
+            self.stats["too_large"] += 1
+            return
+        ttl = self.ttl
+        if "expires" in header:
+            ttl = min(max(int(header["expires"] - utcnow()), 1), ttl)
+        self.client.set(self.key(url, identity), data, ttl, noreply=True)
+        self.stats["sets"] += 1
+
+class DummyBodyCache(BodyCache):
+    def __init__(self, **kw): pass
+    def get(self, url, identity=None): return None
+    def set(self, url, response, header, identity=None): return
+
 
 # -- static modifications --
 
 header_cache = HeaderCache() if settings.enable_header_cache else DummyHeaderCache()
+body_cache = BodyCache() if settings.enable_body_cache else DummyBodyCache()
 
-get = wrapget(requests.get)
-post = wrapget(requests.post)
-head = wrapget(requests.head)
+get = wrapget(pooled("get"))
+post = wrapget(pooled("post"))
+head = wrapget(pooled("head"))
 
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The job envelope put on the queue by the scheduler and run by workers.
+
+An envelope holds a plugin method path (as resolved by
+`PluginRegistry.by_path`), its args, the deadline the job was due at and how
+many times it has been attempted.  It is encoded as a fixed binary header
+followed by the args:
+
+    version  B   envelope format version
+    flags    B   PATH, MSGPACK, NOARGS
+    method   I   crc32 of the method path
+    deadline d   unix time the job was due at, or 0
+    attempts H
+
+Method paths are interned as the crc32 of the path, which scheduler and
+worker compute alike from their plugin registries, so the path itself is only
+sent (after the header, with a 2 byte length) for paths that aren't in the
+registry or whose crc collides with another's.  Args are msgpack encoded
+when msgpack is installed and json otherwise;  a worker without msgpack
+can't read jobs from a scheduler with it.
+
+Decoding reads the header in place with `struct.unpack_from` and hands
+msgpack a buffer over the rest, so the message body is never copied;
+`Envelope.header` reads just the header.  Messages in the older json format
+(`{"path": ..., "args": ...}`) are still decoded."""
+
+import struct
+from zlib import crc32
+
+#import ujson as json
+import simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from arachne import plugin
+
+version = 1
+header = struct.Struct("!BBIdH")
+path_length = struct.Struct("!H")
+
+# flags
+PATH = 0x01
+MSGPACK = 0x02
+NOARGS = 0x04
+
+# method id -> path for every method in the plugin registry, or None for ids
+# that more than one path hashes to, and the registry size it was built at
+_paths = {}
+_interned = [None]
+
+def method_id(path):
+    return crc32(path) & 0xffffffff
+
+def intern_methods():
+    """Rebuild the table of method ids from the plugin registry."""
+    _paths.clear()
+    _interned[0] = (len(plugin.registry), len(plugin.registry.aliases))
+    paths = set(plugin.registry.aliases)
+    for name, plug in plugin.registry.items():
+        paths.update("%s/%s" % (name, method) for method in getattr(plug, "methods", ()))
+    for path in paths:
+        mid = method_id(path)
+        _paths[mid] = None if mid in _paths else path
+
+def method_path(mid):
+    """Return the path for a method id, or None if it is unknown or
+    ambiguous.  Plugins registered since the table was built are found by
+    rebuilding it."""
+    if mid not in _paths and _interned[0] != (len(plugin.registry), len(plugin.registry.aliases)):
+        intern_methods()
+    return _paths.get(mid)
+
+class Envelope(object):
+    """A job as it travels from the scheduler to a worker."""
+    __slots__ = ('path', 'args', 'deadline', 'attempts')
+
+    def __init__(self, path, args=None, deadline=0, attempts=0):
+        self.path = path
+        self.args = args or {}
+        self.deadline = deadline
+        self.attempts = attempts
+
+    def method(self):
+        """Return the plugin method this job runs, or None."""
+        return plugin.registry.by_path(self.path)
+
+    def encode(self):
+        mid = method_id(self.path)
+        flags = 0
+        parts = []
+        if method_path(mid) != self.path:
+            flags |= PATH
+            parts.append(path_length.pack(len(self.path)) + self.path)
+        if not self.args:
+            flags |= NOARGS
+        elif msgpack is not None:
+            flags |= MSGPACK
+            parts.append(msgpack.packb(self.args))
+        else:
+            parts.append(json.dumps(self.args, separators=(',', ':')))
+        head = header.pack(version, flags, mid, self.deadline or 0, self.attempts)
+        return head + "".join(parts)
+
+    @staticmethod
+    def header(data):
+        """Return (flags, method id, deadline, attempts) and the offset of
+        the rest of an encoded envelope, without decoding its args."""
+        v, flags, mid, deadline, attempts = header.unpack_from(data)
+        if v != version:
+            raise ValueError("Unknown job envelope version %d" % v)
+        return (flags, mid, deadline, attempts), header.size
+
+    @classmethod
+    def decode(cls, data):
+        """Decode an envelope, or a job message in the older json format."""
+        if data[:1] == "{":
+            message = json.loads(data)
+            return cls(message["path"], message.get("args", {}))
+        (flags, mid, deadline, attempts), offset = cls.header(data)
+        if flags & PATH:
+            length, = path_length.unpack_from(data, offset)
+            offset += path_length.size
+            path = data[offset:offset + length]
+            offset += length
+        else:
+            path = method_path(mid)
+            if path is None:
+                raise ValueError("Unknown job method id %d" % mid)
+        if flags & NOARGS:
+            args = {}
+        elif flags & MSGPACK:
+            if msgpack is None:
+                raise ValueError("Job args are msgpack encoded, but msgpack isn't installed")
+            # strings come back as unicode, as they do from json
+            args = msgpack.unpackb(buffer(data, offset), encoding="utf-8")
+        else:
+            args = json.loads(data[offset:])
+        return cls(path, args, deadline, attempts)
+
+    def __repr__(self):
+        return "<Envelope %s %r>" % (self.path, self.args)
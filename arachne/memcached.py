@@ -1,27 +1,94 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Wrapper around umemcache which automatically manages distinct connections
-per greenlet."""
+"""Wrapper around umemcache which shares a bounded pool of connections
+between greenlets, and spreads keys over several servers with consistent
+hashing.  Setting `memcached_pool_mode` to "greenlet" restores the older
+behavior of a distinct connection per greenlet."""
 
 import umemcache
 import gevent
+import struct
+import logging
+from time import time
+from bisect import bisect
+from hashlib import md5
+from contextlib import contextmanager
 
 from arachne.conf import settings, merge, require
-from arachne.utils import encode, decode
+from arachne.utils import encode, decode, ConnectionPool
 
 defaults = {
     "port": 11211,
+    "poolsize": 20,
+    "max_idle": 60,
+    "pool_mode": "pool",
+    "max_failures": 2,
+    "retry_timeout": 30,
 }
 
-class Memcached(object):
-    def __init__(self, **kw):
-        config = merge(defaults, settings.like("memcached"), kw)
-        require(self, config, ("host", "port"))
+logger = logging.getLogger(__name__)
+
+class MemcachedConnectionPool(ConnectionPool):
+    def __init__(self, config, maxsize=10):
+        maxsize = int(config.get("poolsize", maxsize))
+        super(MemcachedConnectionPool, self).__init__(maxsize, float(config.get("max_idle", 0)))
         self.config = config
-        self.pool = {}
+
+    def new_connection(self):
+        c = self.config
+        con = umemcache.Client("%s:%s" % (c['host'], c['port']))
+        con.connect()
+        return con
+
+    def check(self, con):
+        return con.is_connected()
+
+    def close(self, con):
+        con.disconnect()
+
+class Ketama(object):
+    """A ketama consistent hash ring, compatible with libketama and the
+    clients which follow it.  Each server gets 160 points on the ring, so
+    adding or removing one only moves the keys nearest its points."""
+    def __init__(self, servers=()):
+        self.build(servers)
+
+    def build(self, servers):
+        ring = {}
+        for server in servers:
+            for i in xrange(40):
+                digest = md5("%s-%d" % (server, i)).digest()
+                for h in xrange(4):
+                    ring[point(digest, h)] = server
+        self.points = sorted(ring)
+        self.servers = [ring[p] for p in self.points]
+
+    def get(self, key):
+        """Return the server for a key, or None if the ring is empty."""
+        if not self.points:
+            return None
+        i = bisect(self.points, point(md5(key).digest()))
+        return self.servers[i if i < len(self.points) else 0]
+
+def point(digest, h=0):
+    """Return the h'th 32 bit little endian point from an md5 digest."""
+    return struct.unpack_from("<I", digest, h * 4)[0]
+
+class Node(object):
+    """A single memcached server and its connections."""
+    def __init__(self, server, config):
+        self.server = server
+        host, port = server.rsplit(":", 1)
+        self.config = merge(config, {"host": host, "port": int(port)})
+        if config["pool_mode"] == "greenlet":
+            self.pool = {}
+        else:
+            self.pool = MemcachedConnectionPool(self.config)
+        self.failures = 0
 
     def client(self):
+        """Return the connection for the current greenlet, in greenlet mode."""
         current = gevent.getcurrent()
         if current in self.pool:
             return self.pool[current]
@@ -31,29 +98,266 @@ class Memcached(object):
         self.pool[current] = con
         return con
 
-    def add(self, key, value):
-        self.client().add(key, value)
+    @contextmanager
+    def connection(self):
+        if isinstance(self.pool, dict):
+            try:
+                yield self.client()
+            except Exception:
+                # don't hold on to a connection that may be broken
+                self.pool.pop(gevent.getcurrent(), None)
+                raise
+        else:
+            with self.pool.connection() as con:
+                yield con
+
+class Memcached(object):
+    """A memcached client for one server (`host` and `port`) or several
+    (`servers`, a list or comma separated string of host:port), with keys
+    spread over them by consistent hashing.  A server which fails
+    `max_failures` times in a row is ejected from the ring for
+    `retry_timeout` seconds;  operations that fail because of it are retried
+    once on the server their key moves to."""
+    def __init__(self, **kw):
+        config = merge(defaults, settings.like("memcached"), kw)
+        servers = config.get("servers")
+        if not servers:
+            require(self, config, ("host", "port"))
+            servers = ["%s:%s" % (config["host"], config["port"])]
+        elif isinstance(servers, basestring):
+            servers = [s.strip() for s in servers.split(",") if s.strip()]
+        self.config = config
+        self.servers = list(servers)
+        self.nodes = dict((server, Node(server, config)) for server in servers)
+        self.ring = Ketama(self.servers)
+        # server -> time after which it is retried
+        self.ejected = {}
+
+    def node(self, key):
+        if self.ejected:
+            now = time()
+            revived = [s for s, retry in self.ejected.items() if retry <= now]
+            if revived:
+                for server in revived:
+                    del self.ejected[server]
+                    self.nodes[server].failures = 0
+                self.ring.build([s for s in self.servers if s not in self.ejected])
+        server = self.ring.get(key)
+        if server is None:
+            raise RuntimeError("No memcached servers available")
+        return self.nodes[server]
+
+    def failed(self, node):
+        """Record a failure on node, ejecting it if it has failed too often.
+        Returns True if it was ejected."""
+        node.failures += 1
+        if node.failures < int(self.config["max_failures"]) or len(self.servers) == 1:
+            return False
+        logger.error("Ejecting memcached server %s for %ss" % (node.server, self.config["retry_timeout"]))
+        self.ejected[node.server] = time() + float(self.config["retry_timeout"])
+        self.ring.build([s for s in self.servers if s not in self.ejected])
+        return True
+
+    def call(self, key, method, *a):
+        """Call a client method for key on the node which owns it."""
+        node = self.node(key)
+        try:
+            with node.connection() as c:
+                result = getattr(c, method)(key, *a)
+        except Exception:
+            if not self.failed(node):
+                raise
+            with self.node(key).connection() as c:
+                result = getattr(c, method)(key, *a)
+        node.failures = 0
+        return result
+
+    def add(self, key, value, expiration=0, noreply=False):
+        """Add key if it doesn't exist.  Returns True if it was stored (always
+        False with noreply)."""
+        return self.call(key, "add", value, expiration, 0, noreply) == "STORED"
 
     def get(self, key):
-        ret = self.client().get(key)
+        ret = self.call(key, "get")
         return ret[0] if ret else ret
 
-    def set(self, key, data, *a):
-        self.client().set(key, data, *a)
+    def gets(self, key):
+        """Return (value, cas_unique) for key, or None."""
+        ret = self.call(key, "gets")
+        return (ret[0], ret[2]) if ret else ret
+
+    def cas(self, key, data, cas_unique, expiration=0):
+        """Set key only if it hasn't changed since gets returned cas_unique.
+        Returns True if it was stored."""
+        return self.call(key, "cas", data, cas_unique, expiration) == "STORED"
+
+    def set(self, key, data, expiration=0, noreply=False):
+        self.call(key, "set", data, expiration, 0, noreply)
+
+    def incr(self, key, delta=1, noreply=False):
+        return self.call(key, "incr", delta, noreply)
+
+    def decr(self, key, delta=1, noreply=False):
+        return self.call(key, "decr", delta, noreply)
 
-    def incr(self, key, *a):
-        self.client().incr(key, *a)
+    def pipeline(self):
+        """Return a Pipeline, which batches operations by server and sends
+        them to each server in parallel (see `Pipeline` for what they cost)::
 
-    def decr(self, key, *a):
-        self.client().decr(key, *a)
+            with client.pipeline() as p:
+                p.add(key, '0')
+                p.incr(key)
+        """
+        return Pipeline(self)
+
+    def set_multi(self, mapping, expiration=0, noreply=True):
+        with self.pipeline() as p:
+            for key, data in mapping.iteritems():
+                p.set(key, data, expiration, noreply)
+
+    def add_multi(self, mapping, expiration=0, noreply=True):
+        with self.pipeline() as p:
+            for key, data in mapping.iteritems():
+                p.add(key, data, expiration, noreply)
+
+    def incr_multi(self, keys, delta=1, noreply=False):
+        """Increment many keys by delta, returning a dict of their new values
+        (None for keys which don't exist), or None if noreply is set.
+        memcached has no multi-key incr, so without noreply this waits on a
+        reply per key, though servers are incremented in parallel."""
+        with self.pipeline() as p:
+            for key in keys:
+                p.incr(key, delta, noreply)
+        if not noreply:
+            return dict(zip(keys, p.results))
+
+    def _get_multi(self, node, keys):
+        try:
+            with node.connection() as c:
+                result = c.get_multi(keys)
+        except Exception:
+            logger.exception("Error in get_multi on %s" % node.server)
+            self.failed(node)
+            return {}
+        node.failures = 0
+        return result
 
     def get_multi(self, *keys):
-        d = self.client().get_multi(keys)
-        return dict([(k,v[0]) for k,v in d.iteritems()])
+        """Get many keys at once, with one request per server made in
+        parallel.  Keys on a server which fails are treated as misses."""
+        by_node = {}
+        for key in keys:
+            by_node.setdefault(self.node(key), []).append(key)
+        if len(by_node) == 1:
+            node, keys = by_node.items()[0]
+            results = [self._get_multi(node, keys)]
+        else:
+            jobs = [gevent.spawn(self._get_multi, n, k) for n, k in by_node.iteritems()]
+            gevent.joinall(jobs)
+            results = [job.value or {} for job in jobs]
+        d = {}
+        for result in results:
+            d.update((k, v[0]) for k, v in result.iteritems())
+        return d
+
+    def each(self, method):
+        """Call a method on every server's client.  Returns the result for a
+        single server, or a dict of results by server."""
+        results = {}
+        for server, node in self.nodes.iteritems():
+            with node.connection() as c:
+                results[server] = getattr(c, method)()
+        if len(results) == 1:
+            return results.values()[0]
+        return results
 
     def version(self):
-        return self.client().version()
+        return self.each("version")
 
     def stats(self):
-        return self.client().stats()
+        return self.each("stats")
+
+    def pool_stats(self):
+        """Return connection pool statistics by server, or None in greenlet
+        mode."""
+        if self.config["pool_mode"] == "greenlet":
+            return None
+        return dict((server, node.pool.stats()) for server, node in self.nodes.iteritems())
+
+class Pipeline(object):
+    """A batch of operations, sent when the pipeline is executed (or its
+    with block exits) on one connection per server, with the servers'
+    batches sent in parallel.  Operations run in order on each server.
+    umemcache waits for each command's reply before sending the next, so
+    writes flagged `noreply` cost no wait, consecutive gets are sent as one
+    get_multi, and every other operation costs a round trip of its own.
+    After execution, `results` holds each operation's result in the order
+    they were added;  operations on a server which fails get None."""
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.execute()
+
+    def add(self, key, value, expiration=0, noreply=True):
+        self.ops.append((key, "add", (value, expiration, 0, noreply)))
+
+    def set(self, key, data, expiration=0, noreply=True):
+        self.ops.append((key, "set", (data, expiration, 0, noreply)))
+
+    def incr(self, key, delta=1, noreply=False):
+        self.ops.append((key, "incr", (delta, noreply)))
+
+    def decr(self, key, delta=1, noreply=False):
+        self.ops.append((key, "decr", (delta, noreply)))
+
+    def delete(self, key, noreply=True):
+        self.ops.append((key, "delete", (0, noreply)))
+
+    def get(self, key):
+        self.ops.append((key, "get", ()))
+
+    def _execute(self, node, ops):
+        try:
+            with node.connection() as c:
+                gets = []
+                for i, key, method, args in ops:
+                    if method == "get":
+                        gets.append((i, key))
+                        continue
+                    if gets:
+                        self._get_multi(c, gets)
+                        gets = []
+                    self.results[i] = getattr(c, method)(key, *args)
+                if gets:
+                    self._get_multi(c, gets)
+        except Exception:
+            logger.exception("Error in pipeline on %s" % node.server)
+            self.client.failed(node)
+            return
+        node.failures = 0
+
+    def _get_multi(self, c, gets):
+        found = c.get_multi([key for i, key in gets])
+        for i, key in gets:
+            result = found.get(key)
+            self.results[i] = result[0] if result else None
 
+    def execute(self):
+        """Send the batched operations, returning their results."""
+        self.results = [None] * len(self.ops)
+        by_node = {}
+        for i, (key, method, args) in enumerate(self.ops):
+            by_node.setdefault(self.client.node(key), []).append((i, key, method, args))
+        self.ops = []
+        if len(by_node) == 1:
+            self._execute(*by_node.items()[0])
+        else:
+            gevent.joinall([gevent.spawn(self._execute, n, o) for n, o in by_node.iteritems()])
+        return self.results
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Offloading of CPU-heavy decoding from greenlets.
+
+Parsing a large json response or decompressing a large stored value blocks
+the gevent hub, stalling every other greenlet's sockets.  When the setting
+`offload_threshold` is set, payloads of at least that many bytes are decoded
+in a pool instead, and the calling greenlet yields until the result is ready.
+`offload_pool` picks the pool:  "thread" uses gevent's native threadpool,
+which helps with zlib (it releases the GIL) but not with json, and "process"
+uses `offload_processes` worker processes, which helps with both at the cost
+of pickling the payload and result.
+
+Time spent decoding inline (during which the hub is stalled) and waiting on
+the pool is recorded in `stats`, for tuning the threshold."""
+
+import logging
+import multiprocessing
+from time import time
+
+import gevent
+from gevent import queue
+from gevent.socket import wait_read
+#import ujson as json
+import simplejson as json
+
+from arachne import utils
+from arachne.conf import settings, merge
+
+defaults = {
+    # payloads smaller than this are decoded inline;  0 disables offloading
+    "threshold": 0,
+    "pool": "thread",
+    "processes": multiprocessing.cpu_count(),
+    # inline calls which stall the hub for longer than this are logged
+    "stall_warning": 0.1,
+}
+
+logger = logging.getLogger(__name__)
+
+stats = {
+    "inline": 0,
+    "inline_time": 0.0,
+    "inline_max": 0.0,
+    "offloaded": 0,
+    "offloaded_time": 0.0,
+    "offloaded_max": 0.0,
+}
+
+_process_pool = None
+
+def config():
+    return merge(defaults, settings.like("offload"))
+
+def process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPool(int(config()["processes"]))
+    return _process_pool
+
+class ProcessPool(object):
+    """A pool of worker processes, each sent calls over a pipe of its own.
+    A multiprocessing.Pool hands out results from threads, which become
+    greenlets once the stdlib is monkey patched;  here the calling greenlet
+    just waits on the hub for its worker's pipe to become readable.  A worker
+    whose call is interrupted (or which dies) is replaced."""
+    def __init__(self, processes):
+        self.idle = queue.Queue()
+        for i in xrange(processes):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve, args=(child,))
+        process.daemon = True
+        process.start()
+        child.close()
+        return process, conn
+
+    def apply(self, func, data):
+        """Return func(data) from a worker, raising what it raised."""
+        process, conn = self.idle.get()
+        try:
+            conn.send((func, data))
+            wait_read(conn.fileno())
+            ok, result = conn.recv()
+        except:
+            # the worker may be left with a reply we'd read as the next one's
+            process.terminate()
+            conn.close()
+            self.idle.put(self.spawn())
+            raise
+        self.idle.put((process, conn))
+        if not ok:
+            raise result
+        return result
+
+def serve(conn):
+    """Run the calls sent to a worker process until its pipe is closed."""
+    while True:
+        try:
+            func, data = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = (True, func(data))
+        except Exception, e:
+            result = (False, e)
+        conn.send(result)
+
+def record(kind, elapsed):
+    stats[kind] += 1
+    stats[kind + "_time"] += elapsed
+    if elapsed > stats[kind + "_max"]:
+        stats[kind + "_max"] = elapsed
+
+def call(func, data):
+    """Call func(data), offloading it if data is over the threshold."""
+    conf = config()
+    threshold = int(conf["threshold"])
+    t0 = time()
+    if not threshold or len(data) < threshold:
+        result = func(data)
+        elapsed = time() - t0
+        record("inline", elapsed)
+        if elapsed > float(conf["stall_warning"]):
+            logger.info("%s of %d bytes stalled for %0.3fs" % (func.__name__, len(data), elapsed))
+        return result
+    if conf["pool"] == "process":
+        result = process_pool().apply(func, data)
+    else:
+        result = gevent.get_hub().threadpool.apply(func, (data,))
+    record("offloaded", time() - t0)
+    return result
+
+def loads(text):
+    """Parse json text, offloading large documents."""
+    return call(json.loads, text)
+
+def decode(data):
+    """Decode data coming out of storage, offloading large values."""
+    return call(utils.decode, data)
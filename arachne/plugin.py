@@ -47,10 +47,11 @@ def argument_alias(method, args):
 def interval(seconds, **kw):
     """Mark a methods interval individually.  You can also pass any other
     keys you want the function to be marked with, ex. for richer QOS interval
-    concepts or any extra data you might want."""
+    concepts or any extra data you might want.  `lane` picks the amqp lane
+    that the scheduler publishes the method's jobs to."""
     def wrapper(func):
         func.interval = seconds
-        for key,value in kw:
+        for key,value in kw.iteritems():
             setattr(func, key, value)
         if kw: func._extras = kw
         return func
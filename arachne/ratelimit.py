@@ -14,9 +14,14 @@ process can proceed.
 
 from hashlib import md5
 from time import strftime, gmtime, time
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
 import math
 import logging
 
+import gevent
+from gevent.event import AsyncResult
+
 from arachne.conf import settings
 from arachne.memcached import Memcached
 
@@ -31,6 +36,24 @@ def get_token(self, resource):
         return True
     return limits[resource].token()
 
+def acquire(resource, timeout=None):
+    """Wait up to timeout seconds (forever if None) for a token for the
+    resource.  Returns True if one was acquired, False on timeout."""
+    if resource not in limits:
+        return True
+    return limits[resource].acquire(timeout)
+
+def limiter(resource):
+    """Return the RateLimit for a resource, registering one without limits
+    (which only follows upstream backoffs) if none is configured."""
+    if resource not in limits:
+        limits[resource] = RateLimit(resource)
+    return limits[resource]
+
+def queue_stats():
+    """Return the wait queue statistics of every configured rate limit."""
+    return dict((resource, limit.queue_stats()) for resource, limit in limits.iteritems())
+
 def window(interval, count=4):
     """Return the previous count timestamps for the interval, which is
     in minutes.  So if the interval is 1 minute and the count is 3,
@@ -40,13 +63,63 @@ def window(interval, count=4):
     now = math.floor(time()/seconds)*seconds
     return [str(int(now-x)) for x in range(0, interval*60, seconds)]
 
+def next_window(interval, count=4):
+    """Return the seconds until the window for the interval next moves on,
+    dropping its oldest timestamp."""
+    seconds = (interval * 60)/count
+    now = time()
+    return (math.floor(now/seconds) + 1)*seconds - now
+
+def parse_delay(value):
+    """Parse a Retry-After value, either seconds or an http date, into the
+    seconds to wait."""
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = parsedate_tz(value)
+        return max(mktime_tz(date) - time(), 0) if date else None
+
+def parse_reset(value):
+    """Parse an X-RateLimit-Reset value, which providers send either as a
+    unix timestamp or as seconds from now, into the seconds to wait."""
+    try:
+        value = float(value)
+    except ValueError:
+        return None
+    return max(value - time(), 0) if value > 1e9 else value
+
+# upper bounds, in seconds, of the acquire wait time histogram buckets
+wait_buckets = (0.01, 0.1, 1, 10, 60, 600)
+
+# compare-and-swap attempts made by the gcra backend before giving up
+cas_retries = 5
+
 class RateLimit(object):
     """Rate limiter which uses sub-sequences of 4 keys for two levels of rate
     limiting granularity:  every 10 seconds for a sliding window of one minute
-    and every 10 minutes for a sliding window of one hour."""
-    def __init__(self, resource, per_minute=0, per_5_minutes=0, per_hour=0):
+    and every 10 minutes for a sliding window of one hour.
+
+    With `backend` (or the `ratelimit_backend` setting) "gcra", the generic
+    cell rate algorithm is used instead:  each limit keeps one memcached key
+    holding its theoretical arrival time in milliseconds, updated with
+    compare-and-swap.  Requests are spaced evenly, with up to `burst`
+    (`ratelimit_burst`, default 1) let through at once, so that at most
+    `rate + burst - 1` go in any sliding `interval`, with no bucket edges."""
+    def __init__(self, resource, per_minute=0, per_5_minutes=0, per_hour=0, backend=None,
+            burst=None):
         self.resource = resource
+        self.backend = backend or settings.get("ratelimit_backend", "window")
+        self.burst = int(burst or settings.get("ratelimit_burst", 1))
         self.limits = {}
+        # for gcra, the time in ms at which the last refused request could go
+        self.next_allowed = 0
+        self.waiters = deque()
+        self.dispatcher = None
+        self.waits = dict((str(b), 0) for b in wait_buckets + ("inf",))
+        self.wait_stats = {"acquired": 0, "waited": 0, "timeouts": 0, "wait_time": 0.0}
+        # no tokens are handed out before this time, after upstream backoffs
+        self.blocked_until = 0
+        self.key = md5(resource).hexdigest()
         if per_minute:
             self.limits["per_minute"] = (per_minute, 60)
         if per_5_minutes:
@@ -55,33 +128,277 @@ class RateLimit(object):
             self.limits["per_hour"] = (per_hour, 3600)
         if not self.limits:
             return
-        self.key = md5(resource).hexdigest()
         limits[resource] = self
 
     def token(self):
+        """Check every limit with one get_multi, and if none are exceeded
+        count the request against each with one pipelined batch."""
+        if self.blocked_until > time():
+            return False
+        if not self.limits:
+            return True
+        if self.backend == "gcra":
+            return self.gcra_token()
+        windows = {}
         for limit, (rate, interval) in self.limits.iteritems():
-            timestamps = window(interval)
-            keys = [self.key+timestamp for timestamp in timestamps]
-            results = ratelimit_cache.get_multi(*keys)
-            gets = sum(map(int, results.values()))
-            if gets >= rate:
-                logger.error("RateLimit %s exceeded for %s" % (limit, self.resource))
+            windows[limit] = [self.key+timestamp for timestamp in window(interval/60)]
+        keys = set(key for keys in windows.itervalues() for key in keys)
+        results = cache().get_multi(*keys)
+        for limit, keys in windows.iteritems():
+            gets = sum(int(results[key]) for key in keys if key in results)
+            if gets >= self.limits[limit][0]:
+                self.exceeded(limit)
                 return False
-            if self.key+timestamps[0] not in results:
-                ratelimit_cache.add(self.key+timestamps[0], '0')
-            ratelimit_cache.incr(self.key+timestamps[0], 1)
+        with cache().pipeline() as p:
+            for key in set(keys[0] for keys in windows.itervalues()):
+                if key not in results:
+                    p.add(key, '0')
+                p.incr(key, 1, noreply=True)
         return True
 
-if not settings.get("disable_ratelimit", False):
-    ratelimit_cache = Memcached(**settings.like("ratelimit_cache"))
-else:
-    ratelimit_cache = None
+    def gcra_token(self):
+        """Take a token from every limit with the gcra backend.  All limits
+        are checked before any is updated;  if an update loses a race with
+        another process the check is repeated, which may leave a limit that
+        was already updated charged for a request that is then refused."""
+        now = int(time() * 1000)
+        done = set()
+        for attempt in xrange(cas_retries):
+            updates = {}
+            for limit, (rate, interval) in self.limits.iteritems():
+                if limit in done:
+                    continue
+                key = self.key + limit
+                result = cache().gets(key)
+                tat = int(result[0]) if result else 0
+                period = interval * 1000
+                emission = period / float(rate)
+                new_tat = max(tat, now) + emission
+                tolerance = emission * self.burst
+                if new_tat - now > tolerance:
+                    self.next_allowed = new_tat - tolerance
+                    self.exceeded(limit)
+                    return False
+                updates[limit] = (key, str(int(math.ceil(new_tat))), result, interval)
+            for limit, (key, value, result, interval) in updates.iteritems():
+                if result is None:
+                    stored = cache().add(key, value, interval + 1)
+                else:
+                    stored = cache().cas(key, value, result[1], interval + 1)
+                if not stored:
+                    break
+                done.add(limit)
+            else:
+                return True
+        logger.error("RateLimit for %s gave up after %d conflicts" % (self.resource, cas_retries))
+        return False
+
+    def exceeded(self, limit):
+        # with greenlets queued in acquire, hitting the limit is expected
+        log = logger.debug if self.waiters else logger.error
+        log("RateLimit %s exceeded for %s" % (limit, self.resource))
+
+    def acquire(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for a token, rather
+        than failing as soon as a limit is reached.  Waiting greenlets are
+        queued in order, and given tokens as the windows move on.  Returns
+        True if a token was acquired, False on timeout."""
+        if not self.waiters and self.token():
+            self.record_wait(0)
+            return True
+        waiter = AsyncResult()
+        self.waiters.append(waiter)
+        if self.dispatcher is None:
+            self.dispatcher = gevent.spawn(self.dispatch)
+        t0 = time()
+        try:
+            # wait rather than get, so that only a caller's own timeout (or
+            # kill) raises here
+            waiter.wait(timeout)
+        finally:
+            # the dispatcher may have given us a token just as we stopped
+            # waiting, in which case we're no longer queued
+            if not waiter.ready() and waiter in self.waiters:
+                self.waiters.remove(waiter)
+        if not waiter.ready():
+            self.wait_stats["timeouts"] += 1
+            return False
+        self.record_wait(time() - t0)
+        return True
+
+    def dispatch(self):
+        """Hand out tokens to queued greenlets, sleeping until the next
+        window moves on whenever a limit is reached."""
+        try:
+            while self.waiters:
+                try:
+                    acquired = self.token()
+                except Exception:
+                    logger.exception("Error getting a token for %s" % self.resource)
+                    acquired = False
+                if acquired:
+                    self.waiters.popleft().set(True)
+                else:
+                    gevent.sleep(self.retry_after())
+        finally:
+            self.dispatcher = None
+
+    def retry_after(self):
+        """Return the seconds until an upstream backoff ends, or until any of
+        the limits' windows move on."""
+        blocked = self.blocked_until - time()
+        if blocked > 0 or not self.limits:
+            return max(blocked, 0.001)
+        if self.backend == "gcra":
+            return max(self.next_allowed / 1000.0 - time(), 0.001)
+        return min(next_window(interval/60) for rate, interval in self.limits.itervalues())
+
+    def backoff(self, seconds):
+        """Hand out no tokens for the next seconds."""
+        until = time() + seconds
+        if until > self.blocked_until:
+            logger.warning("Backing off %s for %0.1fs" % (self.resource, seconds))
+            self.blocked_until = until
+
+    def observe(self, status_code, headers):
+        """Adapt to the rate limit headers of an upstream response, backing
+        off as told by Retry-After on 429s and 503s, and until the reset time
+        once X-RateLimit-Remaining falls to `ratelimit_reserve` (default 0),
+        so that we stop before the provider starts refusing requests.  429s
+        without a usable reset time back off for `ratelimit_backoff` seconds
+        (default 60)."""
+        default = float(settings.get("ratelimit_backoff", 60))
+        retry = headers.get("retry-after")
+        if status_code in (429, 503) and retry:
+            delay = parse_delay(retry)
+            self.backoff(default if delay is None else delay)
+        elif status_code == 429:
+            self.backoff(default)
+        remaining = headers.get("x-ratelimit-remaining")
+        try:
+            remaining = int(remaining) if remaining is not None else None
+        except ValueError:
+            remaining = None
+        if remaining is not None and remaining <= int(settings.get("ratelimit_reserve", 0)):
+            reset = headers.get("x-ratelimit-reset")
+            delay = parse_reset(reset) if reset else None
+            self.backoff(default if delay is None else delay)
+
+    def record_wait(self, elapsed):
+        self.wait_stats["acquired"] += 1
+        if elapsed:
+            self.wait_stats["waited"] += 1
+            self.wait_stats["wait_time"] += elapsed
+        for bound in wait_buckets:
+            if elapsed <= bound:
+                self.waits[str(bound)] += 1
+                break
+        else:
+            self.waits["inf"] += 1
+
+    def queue_stats(self):
+        """Return the wait queue depth, counters, and a histogram of acquire
+        wait times keyed by each bucket's upper bound in seconds."""
+        return dict(self.wait_stats, depth=len(self.waiters), histogram=dict(self.waits))
+
+class LeasedRateLimit(RateLimit):
+    """A RateLimit which leases tokens from the shared counters in batches
+    and hands them out locally, so most calls to token() don't go to
+    memcached at all.
+
+    Each lease is `max_error` of a limit's rate (`ratelimit_max_error`,
+    default 5%).  Unused tokens are given back and a new lease taken every
+    `sync_interval` seconds (`ratelimit_sync_interval`, default 5) or when
+    the current bucket rolls over.  Leases which would take a counter over
+    its rate are trimmed, so limits are never exceeded;  with P processes,
+    up to P leases may be held unused, so the shared counters can run ahead
+    of actual use by at most P * max_error of the rate."""
+    def __init__(self, resource, per_minute=0, per_5_minutes=0, per_hour=0,
+            max_error=None, sync_interval=None):
+        super(LeasedRateLimit, self).__init__(resource, per_minute, per_5_minutes, per_hour)
+        if max_error is None:
+            max_error = settings.get("ratelimit_max_error", 0.05)
+        if sync_interval is None:
+            sync_interval = settings.get("ratelimit_sync_interval", 5)
+        self.max_error = float(max_error)
+        self.sync_interval = float(sync_interval)
+        # limit -> [tokens, key they were leased in, time leased, tokens leased]
+        self.leases = {}
+        self.stats = {"local": 0, "leases": 0, "leased": 0, "returned": 0, "denied": 0}
+
+    def token(self):
+        now = time()
+        if self.blocked_until > now:
+            return False
+        for limit, (rate, interval) in self.limits.iteritems():
+            lease = self.leases.get(limit)
+            # an empty lease is renewed at once, but a refused one isn't
+            # retried until the next sync, so an exhausted limit doesn't
+            # send every call to memcached
+            if (lease is None or (lease[0] <= 0 and lease[3]) or now - lease[2] > self.sync_interval
+                    or lease[1] != self.key+window(interval/60)[0]):
+                lease = self.sync(limit, now)
+            if lease[0] <= 0:
+                self.stats["denied"] += 1
+                self.exceeded(limit)
+                return False
+        for limit in self.limits:
+            self.leases[limit][0] -= 1
+        self.stats["local"] += 1
+        return True
+
+    def sync(self, limit, now):
+        """Give back unused tokens for a limit and lease a new batch,
+        returning the new lease."""
+        rate, interval = self.limits[limit]
+        keys = [self.key+timestamp for timestamp in window(interval/60)]
+        old = self.leases.get(limit)
+        if old is not None and old[0] > 0:
+            # if the get overtakes this on another connection, the tokens
+            # given back are still counted as used, and the lease is smaller
+            cache().decr(old[1], old[0], noreply=True)
+            self.stats["returned"] += old[0]
+        results = cache().get_multi(*keys)
+        used = sum(int(results[key]) for key in keys if key in results)
+        current = results.get(keys[0])
+        count = min(max(1, int(rate * self.max_error)), rate - used)
+        if count > 0:
+            with cache().pipeline() as p:
+                if not current:
+                    p.add(keys[0], '0')
+                p.incr(keys[0], count)
+            value = p.results[-1]
+            if value is not None:
+                # other processes may have leased since we looked
+                over = used - int(current or 0) + value - rate
+                if over > 0:
+                    cache().decr(keys[0], min(over, count), noreply=True)
+                    count -= min(over, count)
+        count = max(count, 0)
+        self.stats["leases"] += 1
+        self.stats["leased"] += count
+        lease = self.leases[limit] = [count, keys[0], now, count]
+        return lease
+
+# connected on first use, so that importing this (and the http layer) doesn't
+# need memcached to be configured
+ratelimit_cache = None
+
+def cache():
+    """Return the memcached client holding the counters, or None if rate
+    limiting is disabled."""
+    global ratelimit_cache
+    if ratelimit_cache is None and not settings.get("disable_ratelimit", False):
+        ratelimit_cache = Memcached(**settings.like("ratelimit_cache"))
+    return ratelimit_cache
 
 def enable():
     global ratelimit_cache
+    settings.disable_ratelimit = False
     ratelimit_cache = Memcached(**settings.like("ratelimit_cache"))
 
 def disable():
     global ratelimit_cache
+    settings.disable_ratelimit = True
     ratelimit_cache = None
 
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A caching DNS resolver for the http layer.
+
+When dnspython is installed, hosts are looked up with it (its sockets are
+made cooperative by gevent's patching) and records are cached for their own
+TTL, clamped between `dns_min_ttl` and `dns_max_ttl`.  Otherwise, and for
+names dnspython can't find (eg. from /etc/hosts), lookups go through gevent's
+hub resolver, which uses c-ares with GEVENT_RESOLVER=ares and a threadpool
+otherwise, and are cached for `dns_ttl`.  Names that can't be resolved are
+cached for `dns_negative_ttl`, and concurrent lookups of one host share a
+query (and its errors)."""
+
+import sys
+import socket
+import logging
+from time import time
+
+import gevent
+from gevent.event import AsyncResult
+
+from arachne.conf import settings, merge
+from arachne.utils import LRUCache
+
+try:
+    from dns import resolver as dnsresolver
+except ImportError:
+    dnsresolver = None
+
+defaults = {
+    "ttl": 300,
+    "min_ttl": 5,
+    "max_ttl": 3600,
+    "negative_ttl": 30,
+    "size": 10000,
+}
+
+logger = logging.getLogger(__name__)
+
+def is_address(host):
+    """Return True if host is an IPv4 or IPv6 address rather than a name."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+class Resolver(object):
+    def __init__(self, **kw):
+        config = merge(defaults, settings.like("dns"), kw)
+        self.config = config
+        self.ttl = float(config["ttl"])
+        self.min_ttl = float(config["min_ttl"])
+        self.max_ttl = float(config["max_ttl"])
+        self.negative_ttl = float(config["negative_ttl"])
+        self.cache = LRUCache(int(config["size"]))
+        self.inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "errors": 0,
+            "coalesced": 0, "lookup_time": 0.0}
+
+    def resolve(self, host):
+        """Return a list of addresses for host."""
+        if is_address(host):
+            return [host]
+        cached = self.cache.get(host)
+        if cached is not None:
+            if isinstance(cached, Exception):
+                self.stats["negative_hits"] += 1
+                raise cached
+            self.stats["hits"] += 1
+            return cached
+        lookup = self.inflight.get(host)
+        if lookup is not None:
+            self.stats["coalesced"] += 1
+            return lookup.get()
+        self.stats["misses"] += 1
+        lookup = self.inflight[host] = AsyncResult()
+        t0 = time()
+        try:
+            addresses, ttl = self.lookup(host)
+        except:
+            # any error is shared with concurrent lookups, but only a failure
+            # to resolve the name is cached
+            e = sys.exc_info()[1]
+            self.stats["errors"] += 1
+            if isinstance(e, socket.gaierror):
+                self.cache.set(host, e, self.negative_ttl)
+            lookup.set_exception(e)
+            raise
+        else:
+            self.cache.set(host, addresses, ttl)
+            lookup.set(addresses)
+            return addresses
+        finally:
+            self.stats["lookup_time"] += time() - t0
+            del self.inflight[host]
+
+    def lookup(self, host):
+        """Look up host, returning a list of addresses and how long to keep
+        them.  Raises socket.gaierror if the host can't be resolved."""
+        if dnsresolver is not None:
+            try:
+                answer = dnsresolver.query(host, 'A')
+                ttl = min(max(answer.rrset.ttl, self.min_ttl), self.max_ttl)
+                return [record.address for record in answer], ttl
+            except Exception, e:
+                logger.debug("dnspython lookup of %s failed: %s" % (host, e))
+        infos = gevent.get_hub().resolver.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        return addresses, self.ttl
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """Like socket.create_connection, but resolving the host through the
+        cache.  Each resolved address is tried in turn."""
+        host, port = address
+        error = None
+        for addr in self.resolve(host):
+            try:
+                return socket.create_connection((addr, port), timeout)
+            except socket.error, e:
+                error = e
+        raise error or socket.error("No addresses for %s" % host)
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Job scheduling for the scheduler server.  Jobs are (plugin method, args)
+pairs which are re-run every `interval` seconds;  they are kept in a heap
+ordered by their next deadline and published to the queue when they come
+due."""
+
+import inspect
+import logging
+from itertools import count
+from collections import deque
+from operator import itemgetter
+from heapq import heapify
+from time import time
+
+import gevent
+#import ujson as json
+import simplejson as json
+
+from arachne import plugin
+from arachne.job import Envelope
+from arachne.conf import settings, merge
+from arachne.utils import Heap
+
+defaults = {
+    "batch_size": 500,
+    "tick": 1.0,
+    "backend": "heap",
+    "resolution": 1.0,
+}
+
+logger = logging.getLogger(__name__)
+
+def job_key(path, args):
+    """Return a hashable key uniquely identifying a path and its arguments."""
+    if not args:
+        return path
+    return "%s?%s" % (path, json.dumps(args, sort_keys=True))
+
+def required_args(method):
+    """Return the names of arguments to method which have no defaults."""
+    spec = inspect.getargspec(method)
+    args = [a for a in spec.args if a != 'self']
+    return args[:len(args) - len(spec.defaults or ())]
+
+class Job(object):
+    """A recurring call to a plugin method.  Slotted, since a scheduler can
+    easily have millions of these."""
+    __slots__ = ('path', 'args', 'interval', 'key', 'lane')
+
+    def __init__(self, path, args=None, interval=plugin.hourly, lane=None):
+        self.path = path
+        self.args = args or {}
+        self.interval = interval
+        self.key = job_key(path, self.args)
+        self.lane = lane
+
+    def message(self, deadline=0):
+        """Return the string put on the queue for this job, an encoded
+        `job.Envelope`."""
+        return Envelope(self.path, self.args, deadline).encode()
+
+    @classmethod
+    def parse(cls, message):
+        """Return a Job from a message created with `Job.message`."""
+        envelope = Envelope.decode(message)
+        return cls(envelope.path, envelope.args)
+
+    def __repr__(self):
+        return "<Job %s every %ss>" % (self.key, self.interval)
+
+class JobHeap(Heap):
+    """A heap of [deadline, sequence, job] entries which supports O(log n)
+    reschedule and cancel by job key.  Cancelled entries are left in the heap
+    with their job set to None and skipped when they surface;  the heap is
+    compacted if they come to outnumber the live entries."""
+    def __init__(self):
+        super(JobHeap, self).__init__()
+        self.entries = {}
+        self.counter = count()
+        self.removed = 0
+
+    def schedule(self, job, deadline):
+        """Add a job to the heap, replacing any job with the same key."""
+        self.cancel(job.key)
+        entry = [deadline, next(self.counter), job]
+        self.entries[job.key] = entry
+        self.push(entry)
+
+    def reschedule(self, key, deadline):
+        """Move an existing job to a new deadline.  Returns False if there
+        is no job with that key."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        self.schedule(entry[2], deadline)
+        return True
+
+    def cancel(self, key):
+        """Remove a job from the heap.  Returns False if it wasn't there."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self.removed += 1
+        if self.removed > len(self.entries) and self.removed > 1024:
+            self.compact()
+        return True
+
+    def compact(self):
+        """Rebuild the heap without cancelled entries."""
+        self.items = [e for e in self.items if e[2] is not None]
+        heapify(self.items)
+        self.removed = 0
+
+    def _clean(self):
+        items = self.items
+        while items and items[0][2] is None:
+            self.pop()
+            self.removed -= 1
+
+    def peek(self):
+        """Return the (deadline, job) which is due next, or None."""
+        self._clean()
+        if not self.items:
+            return None
+        deadline, _, job = self.items[0]
+        return deadline, job
+
+    def wait(self, now):
+        """Return the number of seconds until the next job is due."""
+        head = self.peek()
+        return None if head is None else head[0] - now
+
+    def pop_due(self, now, limit=None):
+        """Pop up to `limit` jobs whose deadlines are at or before now, in
+        deadline order.  Returns a list of (deadline, job) tuples."""
+        due = []
+        items = self.items
+        while items and (limit is None or len(due) < limit):
+            deadline, _, job = items[0]
+            if job is None:
+                self.pop()
+                self.removed -= 1
+                continue
+            if deadline > now:
+                break
+            self.pop()
+            del self.entries[job.key]
+            due.append((deadline, job))
+        return due
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+class Slot(dict):
+    """A slot in a TimingWheel, which knows which level it is on."""
+    __slots__ = ('level',)
+    def __init__(self, level):
+        self.level = level
+
+class TimingWheel(object):
+    """A hierarchical timing wheel with the same interface as JobHeap, but
+    O(1) schedule, cancel and expiry.  Deadlines are rounded to ticks of
+    `resolution` seconds;  the first level has a slot for each of the next
+    256 ticks, and each further level has 64 slots which span a whole
+    rotation of the level beneath it.  When the first level wraps around, the
+    next slot of the level above is cascaded down into it.  Jobs due beyond
+    the last level's span are kept in its furthest slot and re-cascaded.
+
+    A tick is expired once it has ended, so jobs are never early but may be
+    up to `resolution` late.  Jobs expiring in the same tick are returned in
+    deadline order."""
+    sizes = (256, 64, 64, 64)
+
+    def __init__(self, resolution=1.0, now=None):
+        self.resolution = float(resolution)
+        self.levels = [[Slot(level) for i in xrange(size)] for level, size in enumerate(self.sizes)]
+        self.counts = [0] * len(self.sizes)
+        self.spans, self.shifts, span, shift = [], [], 1, 0
+        for size in self.sizes:
+            self.shifts.append(shift)
+            span, shift = span * size, shift + size.bit_length() - 1
+            self.spans.append(span)
+        # the next tick to expire
+        self.current = self.tick(time() if now is None else now)
+        # expired entries that have not been popped yet, in deadline order;
+        # cancelled keys are left in ready_order and skipped when they surface
+        self.ready = Slot(None)
+        self.ready_order = deque()
+        # job key -> the slot it is in
+        self.entries = {}
+
+    def tick(self, deadline):
+        return int(deadline // self.resolution)
+
+    def _insert(self, deadline, job):
+        tick = int(deadline // self.resolution)
+        delta = tick - self.current
+        if delta < 0:
+            self.ready[job.key] = (deadline, job)
+            self.ready_order.append(job.key)
+            self.entries[job.key] = self.ready
+            return
+        # the first level covers 8 bits of delta, and each other level 6
+        bits = delta.bit_length()
+        level = 0 if bits <= 8 else (bits - 3) // 6
+        if level >= len(self.sizes):
+            # too far in the future;  park it in the furthest slot
+            level = len(self.sizes) - 1
+            tick = self.current + self.spans[-1] - 1
+        slot = self.levels[level][(tick >> self.shifts[level]) % self.sizes[level]]
+        slot[job.key] = (deadline, job)
+        self.entries[job.key] = slot
+        self.counts[level] += 1
+
+    def schedule(self, job, deadline):
+        """Add a job to the wheel, replacing any job with the same key."""
+        self.cancel(job.key)
+        self._insert(deadline, job)
+
+    def reschedule(self, key, deadline):
+        slot = self.entries.get(key)
+        if slot is None:
+            return False
+        self.schedule(slot[key][1], deadline)
+        return True
+
+    def cancel(self, key):
+        slot = self.entries.pop(key, None)
+        if slot is None:
+            return False
+        del slot[key]
+        if slot.level is not None:
+            self.counts[slot.level] -= 1
+        return True
+
+    def _expire(self, slot):
+        """Move the entries in a first level slot to the ready list."""
+        ready, order, entries = self.ready, self.ready_order, self.entries
+        for entry in sorted(slot.itervalues(), key=itemgetter(0)):
+            key = entry[1].key
+            ready[key] = entry
+            order.append(key)
+            entries[key] = ready
+        self.counts[0] -= len(slot)
+        slot.clear()
+
+    def _cascade(self, level):
+        """Re-insert the current slot of a level into the levels below it."""
+        slot = self.levels[level][(self.current >> self.shifts[level]) % self.sizes[level]]
+        entries = slot.values()
+        self.counts[level] -= len(entries)
+        slot.clear()
+        for deadline, job in entries:
+            self._insert(deadline, job)
+
+    def advance(self, now):
+        """Expire every tick which has ended by now."""
+        target = self.tick(now) - 1
+        if not self.entries:
+            self.current = max(self.current, target + 1)
+            return
+        first = self.levels[0]
+        while self.current <= target:
+            if not self.current % self.sizes[0]:
+                for level in range(1, len(self.sizes)):
+                    self._cascade(level)
+                    if (self.current >> self.shifts[level]) % self.sizes[level]:
+                        break
+            if not self.counts[0]:
+                # skip ahead to the next cascade of an occupied level
+                level = 1
+                while level < len(self.sizes) - 1 and not self.counts[level]:
+                    level += 1
+                span = self.spans[level - 1]
+                self.current = min(target + 1, (self.current // span + 1) * span)
+                continue
+            slot = first[self.current % self.sizes[0]]
+            self.current += 1
+            if slot:
+                self._expire(slot)
+
+    def peek(self):
+        """Return the (deadline, job) due next.  This scans for the nearest
+        occupied slot, and is meant for introspection rather than for every
+        tick;  use `wait` for that."""
+        for key in self.ready_order:
+            if key in self.ready:
+                return self.ready[key]
+        heads = []
+        for level, slots in enumerate(self.levels):
+            size = self.sizes[level]
+            # the current slot of the upper levels has already been cascaded,
+            # so anything in it is a whole rotation away
+            start = (self.current >> self.shifts[level]) % size + (level > 0)
+            for i in xrange(size):
+                slot = slots[(start + i) % size]
+                if slot:
+                    heads.append(min(slot.itervalues(), key=itemgetter(0)))
+                    break
+        return min(heads, key=itemgetter(0)) if heads else None
+
+    def wait(self, now):
+        """Return the number of seconds until the next tick ends."""
+        if self.ready:
+            return 0
+        return (self.current + 1) * self.resolution - now
+
+    def pop_due(self, now, limit=None):
+        self.advance(now)
+        due = []
+        ready, order, entries = self.ready, self.ready_order, self.entries
+        while ready and (limit is None or len(due) < limit):
+            key = order.popleft()
+            entry = ready.pop(key, None)
+            if entry is not None:
+                del entries[key]
+                due.append(entry)
+        return due
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+def job_store(backend=None, **kw):
+    """Return a new job store for a backend name, "heap" or "wheel"."""
+    config = merge(defaults, settings.like("scheduler"), kw)
+    backend = backend or config["backend"]
+    if backend == "heap":
+        return JobHeap()
+    if backend == "wheel":
+        return TimingWheel(config["resolution"])
+    raise ValueError("Unknown scheduler backend \"%s\"" % backend)
+
+class Scheduler(object):
+    """Pops due jobs off of a job store and publishes them to a queue in
+    batches of `batch_size`, rescheduling each one `interval` seconds after
+    the deadline it was due at.  The store defaults to a JobHeap."""
+    def __init__(self, jobs=None, queue=None, **kw):
+        config = merge(defaults, settings.like("scheduler"), kw)
+        self.config = config
+        self.batch_size = int(config["batch_size"])
+        self.tick = float(config["tick"])
+        self.jobs = jobs if jobs is not None else JobHeap()
+        self.queue = queue
+        self.published = 0
+
+    def add(self, path, args=None, interval=None, deadline=None, lane=None):
+        """Schedule the plugin method at path with args.  The interval
+        defaults to the method's interval, the lane to the method's lane (see
+        `plugin.interval`), and the first deadline to now."""
+        method = plugin.registry.by_path(path)
+        if method is None:
+            raise ValueError("No plugin method found at path \"%s\"" % path)
+        job = Job(path, args, interval or method.interval, lane or getattr(method, "lane", None))
+        self.jobs.schedule(job, time() if deadline is None else deadline)
+        return job
+
+    def push(self, path, args=None, lane=None):
+        """Publish a job for the plugin method at path right away, outside of
+        its schedule, eg. for a refresh that a user asked for.  With amqp
+        lanes, pass the lane for such jobs (eg. "interactive")."""
+        if plugin.registry.by_path(path) is None:
+            raise ValueError("No plugin method found at path \"%s\"" % path)
+        job = Job(path, args, lane=lane)
+        self.publish(job)
+        flush = getattr(self.queue, "flush", None)
+        if flush is not None:
+            flush()
+        return job
+
+    def cancel(self, path, args=None):
+        return self.jobs.cancel(job_key(path, args))
+
+    def reschedule(self, path, args=None, deadline=None):
+        deadline = time() if deadline is None else deadline
+        return self.jobs.reschedule(job_key(path, args), deadline)
+
+    def load(self, plugins):
+        """Schedule every exposed method on plugins which can be run without
+        arguments.  Jobs for methods that take arguments must be added by the
+        server with `add`."""
+        for plug in plugins:
+            for name, method in plug.methods.iteritems():
+                if not required_args(method):
+                    self.add("%s/%s" % (plug.plugin_name, name))
+
+    def publish(self, job, deadline=0):
+        """Publish a job to its lane, sharded by its key."""
+        self.queue.publish(job.message(deadline), lane=job.lane, key=job.key)
+
+    def dispatch(self, now=None):
+        """Publish one batch of due jobs and reschedule them.  Returns the
+        number of jobs dispatched."""
+        now = now or time()
+        due = self.jobs.pop_due(now, self.batch_size)
+        for deadline, job in due:
+            try:
+                self.publish(job, deadline)
+            except Exception:
+                logger.exception("Error publishing %r" % job)
+            # keep jobs on their interval, but don't try to catch up on ones
+            # we fell behind on
+            deadline = deadline + job.interval
+            self.jobs.schedule(job, deadline if deadline > now else now + job.interval)
+        # send the batch now rather than waiting on a batching publisher
+        flush = getattr(self.queue, "flush", None)
+        if due and flush is not None:
+            try:
+                flush()
+            except Exception:
+                logger.exception("Error flushing %d published jobs" % len(due))
+        self.published += len(due)
+        return len(due)
+
+    def run(self):
+        """Dispatch jobs forever, sleeping until the next deadline (or for
+        at most `tick` seconds) when nothing is due."""
+        while 1:
+            if self.dispatch() >= self.batch_size:
+                gevent.sleep(0)
+                continue
+            wait = self.jobs.wait(time())
+            gevent.sleep(max(0, self.tick if wait is None else min(wait, self.tick)))
+
+    def info(self):
+        head = self.jobs.peek()
+        return {
+            "length": len(self.jobs),
+            "published": self.published,
+            "next": None if head is None else {"deadline": head[0], "path": head[1].key},
+        }
@@ -3,6 +3,7 @@
 
 """servers."""
 
+import os
 import logging
 import traceback
 from uuid import uuid4
@@ -10,11 +11,14 @@ from time import time, mktime
 from functools import wraps
 
 import gevent
+from gevent.pool import Pool
 from gevent.wsgi import WSGIServer, WSGIHandler
-from arachne.http import HttpError, CacheHit
+from arachne.http import HttpError, CacheHit, pool_manager, flights, resolver
 from arachne.conf import settings
-from arachne.utils import argspec, Heap
-from arachne import amqp
+from arachne.utils import argspec
+from arachne.scheduler import Scheduler, job_store
+from arachne.job import Envelope
+from arachne import amqp, offload
 
 import traceback
 
@@ -44,6 +48,9 @@ class Server(object):
         settings.server = self
         self.proxy = None
         self.greenlets = []
+        # set by the supervisor when running as one of several processes
+        self.listener = None
+        self.supervisor = None
 
     def run_method(self, method, **args):
         """Runs a method with some arguments, catching all manner of error
@@ -64,8 +71,33 @@ class Server(object):
         except Exception, e:
             return traceback.format_exc()
 
+    def save_result(self, args, result):
+        """Save a successful result to the datastore.  Returns the uuid it was
+        saved under, or None if it was not saved."""
+        user_id = args.get('site_user_id', args.get('user_id', None))
+        # XXX: is this really enough of a "success" condition?
+        if user_id and isinstance(result, (dict, list)):
+            uuid = uuid4().hex
+            self.datastore.set(user_id, result, uuid)
+            return uuid
+        return None
+
+    def info(self):
+        """Return a dictionary describing the status of this server."""
+        return {
+            "time": time(),
+            "pid": os.getpid(),
+            "plugins": [p.plugin_name for p in self.plugins],
+            "port": self.port,
+            "state": getattr(self, "state", "running"),
+            "offload": offload.stats,
+            "http": pool_manager.stats(),
+            "coalesced": flights.stats,
+            "dns": resolver.stats,
+        }
+
     def serve(self, port, app, block=False):
-        server = WSGIServer(('', port), app)
+        server = WSGIServer(self.listener or ('', port), app)
         server.handler_class = CustomHandler
         if not block:
             self.greenlets.append(gevent.spawn(server.serve_forever))
@@ -73,6 +105,8 @@ class Server(object):
             server.serve_forever()
 
 class QueueServer(Server):
+    queue_status = None
+
     def start(self):
         self.queue = amqp.Amqp()
         self.state = "initializing"
@@ -80,11 +114,22 @@ class QueueServer(Server):
         self.update_queue_status(self.queue)
         self.run()
 
+    def info(self):
+        info = super(QueueServer, self).info()
+        info["queue"] = self.queue_status
+        info["amqp"] = amqp.rates()
+        return info
+
     @autospawn
     def update_queue_status(self, queue):
+        """Keep `queue_status` up to date from the client's shared status
+        snapshot, which is refreshed at most every `amqp_status_ttl`."""
         while 1:
-            self.queue_status = queue.status()
-            gevent.sleep(10)
+            try:
+                self.queue_status = queue.status()
+            except Exception, e:
+                logger.error("Error getting queue status: %s" % e)
+            gevent.sleep(float(queue.status_ttl) or 10)
 
     def run(self):
         """Subclass and implement a scheduler that puts jobs on self.queue."""
@@ -99,16 +144,114 @@ class SchedulerServer(QueueServer):
         self.state = "stopped"
         self.plugins = [p() for p in plugins]
         self.app = app
-        self.jobheap = Heap()
+        self.jobheap = job_store()
+        self.scheduler = Scheduler(self.jobheap)
+        self.publisher = None
+
+    def info(self):
+        info = super(SchedulerServer, self).info()
+        info["heap"] = self.scheduler.info()
+        if self.publisher is not None:
+            info["publisher"] = self.publisher.stats
+        return info
+
+    def load_jobs(self):
+        """Schedule jobs.  By default, every plugin method which can be run
+        without arguments is scheduled;  subclass and use `self.scheduler.add`
+        to schedule methods with arguments."""
+        self.scheduler.load(self.plugins)
+
+    def run(self):
+        # a connection of its own, as self.queue's is used for status
+        self.publisher = amqp.Publisher()
+        self.scheduler.queue = self.publisher
+        self.load_jobs()
+        self.state = "running"
+        self.scheduler.run()
 
 
 class WorkerServer(QueueServer):
-    def __init__(self, port=settings.port, plugins=[], debug=False, app=None):
+    def __init__(self, port=settings.port, plugins=[], debug=False, app=None, concurrency=None):
         super(WorkerServer, self).__init__()
         self.port = port
         self.state = "stopped"
         self.plugins = [p() for p in plugins]
         self.app = app
+        self.concurrency = int(concurrency or settings.get("worker_concurrency", 100))
+        self.stats = {"executed": 0, "failed": 0, "invalid": 0, "lag": 0.0}
+
+    def info(self):
+        info = super(WorkerServer, self).info()
+        pool = getattr(self, "pool", None)
+        info.update({
+            "concurrency": self.concurrency,
+            "running": len(pool) if pool is not None else 0,
+            "jobs": self.stats,
+        })
+        consumer = getattr(self, "consumer", None)
+        if consumer is not None:
+            info["consumer"] = consumer.info()
+        return info
+
+    def start(self):
+        from arachne.cassandra import Cassandra
+        self.datastore = Cassandra()
+        super(WorkerServer, self).start()
+
+    def run(self):
+        """Execute jobs from the queue in a pool of `concurrency` greenlets.
+        Messages are only acked once they have been run, so the broker will
+        have at most `amqp_prefetch_count` jobs out to this worker at a time,
+        and at most `amqp_queue_size` of those wait locally for the pool.
+        Acks are batched, so the prefetch count is raised if need be to
+        cover the pool plus the two batches of acks a consumer can hold back
+        (see `amqp.Consumer`)."""
+        self.pool = Pool(self.concurrency)
+        ack_every = int(self.queue.ack_every)
+        prefetch = max(int(self.queue.prefetch_count), self.concurrency + 2 * ack_every)
+        if prefetch > int(self.queue.prefetch_count):
+            logger.info("Raising prefetch_count from %s to %s for concurrency %s" % (
+                self.queue.prefetch_count, prefetch, self.concurrency))
+        self.consumer = amqp.Consumer(size=self.queue.queue_size, no_ack=False,
+            prefetch=prefetch, ack_every=ack_every)
+        self.greenlets.append(gevent.spawn(self.consumer.start))
+        self.state = "running"
+        while 1:
+            self.pool.wait_available()
+            message = self.consumer.get()
+            self.pool.spawn(self.execute, message)
+
+    def execute(self, message):
+        """Run the job in a message, save its result, and ack it.  The
+        message is acked whatever happens, since an unacked one holds back
+        the consumer's acks."""
+        try:
+            try:
+                job = Envelope.decode(message.body)
+                method = job.method()
+            except Exception:
+                method = None
+            if method is None:
+                logger.error("Invalid job: %r" % message.body)
+                self.stats["invalid"] += 1
+                return
+            if job.deadline:
+                # total seconds jobs started after they were due
+                self.stats["lag"] += max(0, time() - job.deadline)
+            result = self.run_method(method, **job.args)
+            if isinstance(result, basestring) and "Traceback" in result:
+                logger.error("Error running %s:\n%s" % (job.path, result))
+                self.stats["failed"] += 1
+                return
+            try:
+                self.save_result(job.args, result)
+            except Exception:
+                logger.exception("Error saving the result of %s" % job.path)
+                self.stats["failed"] += 1
+            else:
+                self.stats["executed"] += 1
+        finally:
+            self.consumer.ack(message)
 
 
 class InterfaceServer(Server):
@@ -126,12 +269,9 @@ class InterfaceServer(Server):
     def run_method(self, method, **args):
         """Run a method and save its results to the datastore.  Returns either
         a string (on failures) or a dict to be sent to the client."""
-        user_id = args.get('site_user_id', args.get('user_id', None))
         result = super(InterfaceServer, self).run_method(method, **args)
-        # XXX: is this really enough of a "success" condition?
-        if user_id and isinstance(result, (dict, list)):
-            uuid = uuid4().hex
-            self.datastore.set(user_id, result, uuid)
+        uuid = self.save_result(args, result)
+        if uuid:
             return {uuid: result}
         return result
 
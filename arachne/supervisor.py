@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Pre-fork process supervision, so that a server can use more than one core.
+
+The supervisor binds the server's listening socket, then forks `processes`
+children which each build their own server (and so their own AMQP and
+datastore connections) and serve on the shared socket.  Children which die
+are restarted.  Each child periodically writes its `info()` to a status
+directory, so any child answering `/info/` can report on all of them::
+
+    Supervisor(lambda: WorkerServer(plugins=plugins), port=5000).start()
+
+This is meant for the worker and interface servers;  running more than one
+scheduler would publish every job once per scheduler.
+"""
+
+import os
+import errno
+import signal
+import logging
+import tempfile
+import shutil
+import multiprocessing
+from time import time, sleep
+
+import gevent
+from gevent import socket
+#import ujson as json
+import simplejson as json
+
+from arachne.conf import settings, merge
+
+defaults = {
+    "processes": multiprocessing.cpu_count(),
+    "backlog": 1024,
+    "status_interval": 5,
+    # a child that dies sooner than this after starting is restarted after
+    # a delay, rather than immediately, to avoid a fork storm
+    "min_uptime": 1,
+}
+
+logger = logging.getLogger(__name__)
+
+def aggregate(infos):
+    """Sum the numeric values, and the numeric values of dictionaries, from
+    a list of server info dictionaries."""
+    totals = {}
+    for info in infos:
+        for key, value in info.iteritems():
+            if key in ("time", "port", "pid", "index"):
+                continue
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value
+            elif isinstance(value, dict):
+                sub = totals.setdefault(key, {})
+                for k, v in value.iteritems():
+                    if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                        sub[k] = sub.get(k, 0) + v
+    return totals
+
+class Supervisor(object):
+    """Forks and supervises copies of a server.  `factory` is called in each
+    child to create the server that it runs."""
+    def __init__(self, factory, port=settings.port, **kw):
+        config = merge(defaults, settings.like("supervisor"), kw)
+        self.config = config
+        self.factory = factory
+        self.port = port
+        self.processes = int(config["processes"])
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+        self.statusdir = None
+        self.listener = None
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', self.port))
+        self.listener.listen(int(self.config["backlog"]))
+        self.statusdir = tempfile.mkdtemp(prefix="arachne-%s-" % self.port)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.processes):
+            self.spawn(index)
+        try:
+            self.watch()
+        finally:
+            shutil.rmtree(self.statusdir, True)
+
+    def spawn(self, index):
+        pid = gevent.fork()
+        if pid:
+            self.children[pid] = index
+            self.started[pid] = time()
+            logger.info("Started child %d (pid %d)" % (index, pid))
+            return pid
+        # in the child
+        code = 0
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            server = self.factory()
+            server.listener = self.listener
+            server.supervisor = self
+            server.greenlets.append(gevent.spawn(self.report, server, index))
+            server.start()
+            gevent.joinall(server.greenlets)
+        except Exception:
+            logger.exception("Child %d exiting on error" % index)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def watch(self):
+        """Wait on children, restarting any that exit until stopped."""
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            self.remove_status(index)
+            if self.stopping:
+                continue
+            logger.error("Child %d (pid %d) exited with status %d;  restarting" % (index, pid, status))
+            if time() - self.started.pop(pid) < float(self.config["min_uptime"]):
+                sleep(float(self.config["min_uptime"]))
+            self.spawn(index)
+
+    def stop(self, *a):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def status_file(self, index):
+        return os.path.join(self.statusdir, "%d.json" % index)
+
+    def remove_status(self, index):
+        try:
+            os.unlink(self.status_file(index))
+        except OSError:
+            pass
+
+    def report(self, server, index):
+        """Periodically write a child's server info to the status directory."""
+        path = self.status_file(index)
+        while 1:
+            try:
+                with open(path + ".tmp", "w") as f:
+                    f.write(json.dumps(dict(server.info(), index=index)))
+                os.rename(path + ".tmp", path)
+            except Exception:
+                logger.exception("Error writing status for child %d" % index)
+            gevent.sleep(float(self.config["status_interval"]))
+
+    def status(self):
+        """Return the last reported info for every child, and their totals."""
+        children = []
+        for name in sorted(os.listdir(self.statusdir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.statusdir, name)) as f:
+                    children.append(json.loads(f.read()))
+            except (IOError, ValueError):
+                continue
+        return {
+            "processes": self.processes,
+            "reporting": len(children),
+            "totals": aggregate(children),
+            "children": children,
+        }
@@ -11,7 +11,7 @@ import zlib
 import simplejson as json
 import logging
 from functools import wraps
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 class Registry(defaultdict):
     """An OpenStruct-like registry."""
@@ -53,26 +53,88 @@ import contextlib
 class ConnectionPool(object):
     """A simple connection pool which uses a queue to limit how many
     connections to a single resource are made.  Override the `connection`
-    method to make new connections to your resource."""
-    def __init__(self, maxsize=10):
+    method to make new connections to your resource.
+
+    Connections which have sat unused for longer than `max_idle` seconds
+    (if set) are closed, and connections for which `check` returns False are
+    replaced when they are next taken from the pool.  Override `check` and
+    `close` for your resource."""
+    def __init__(self, maxsize=10, max_idle=0):
         self.maxsize = maxsize
+        self.max_idle = max_idle
+        # a queue of (connection, time last used)
         self.pool = Queue()
         self.size = 0
+        self.last_reap = time.time()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.created = 0
+        self.discarded = 0
 
     def get(self):
         pool = self.pool
-        if self.size >= self.maxsize or pool.qsize():
-            return pool.get()
-        self.size += 1
-        try:
-            con = self.new_connection()
-        except:
-            self.size -= 1
-            raise
-        return con
+        while 1:
+            if self.size >= self.maxsize or pool.qsize():
+                if not pool.qsize():
+                    t0 = time.time()
+                    con, used = pool.get()
+                    self.waits += 1
+                    self.wait_time += time.time() - t0
+                else:
+                    con, used = pool.get()
+                if self.max_idle and time.time() - used > self.max_idle or not self.check(con):
+                    self.discard(con)
+                    continue
+                return con
+            self.size += 1
+            try:
+                con = self.new_connection()
+            except:
+                self.size -= 1
+                raise
+            self.created += 1
+            return con
 
     def put(self, con):
-        self.pool.put(con)
+        now = time.time()
+        self.pool.put((con, now))
+        if self.max_idle and now - self.last_reap > self.max_idle:
+            self.reap(now)
+
+    def discard(self, con):
+        """Close a connection and make room for a new one."""
+        self.size -= 1
+        self.discarded += 1
+        try:
+            self.close(con)
+        except Exception:
+            pass
+
+    def reap(self, now=None):
+        """Close the connections which have been idle for over `max_idle`."""
+        now = now or time.time()
+        self.last_reap = now
+        keep = []
+        while self.pool.qsize():
+            con, used = self.pool.get()
+            if now - used > self.max_idle:
+                self.discard(con)
+            else:
+                keep.append((con, used))
+        for item in keep:
+            self.pool.put(item)
+
+    def stats(self):
+        return {"size": self.size, "idle": self.pool.qsize(), "maxsize": self.maxsize,
+            "created": self.created, "discarded": self.discarded,
+            "waits": self.waits, "wait_time": self.wait_time}
+
+    def check(self, con):
+        """Return False if a connection is no longer usable."""
+        return True
+
+    def close(self, con):
+        pass
 
     @contextlib.contextmanager
     def connection(self):
@@ -86,6 +148,62 @@ class ConnectionPool(object):
         raise NotImplementedError
 
 
+class LRUCache(object):
+    """A bounded in-process cache.  Once it holds more than `maxsize`
+    entries, or more than `maxbytes` bytes as measured by `sizeof`, the least
+    recently used entries are evicted.  Entries expire after `ttl` seconds,
+    which can also be set per entry;  a ttl of 0 never expires."""
+    def __init__(self, maxsize=1000, maxbytes=0, ttl=0, sizeof=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        # key -> (value, expires, size)
+        self.data = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.data.pop(key, None)
+        if entry is None or (entry[1] and entry[1] <= time.time()):
+            if entry is not None:
+                self.bytes -= entry[2]
+            self.misses += 1
+            return default
+        self.data[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        self.delete(key)
+        ttl = self.ttl if ttl is None else ttl
+        size = self.sizeof(value) if self.maxbytes else 0
+        self.data[key] = (value, time.time() + ttl if ttl else 0, size)
+        self.bytes += size
+        while len(self.data) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+            key, entry = self.data.popitem(last=False)
+            self.bytes -= entry[2]
+
+    def delete(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        self.data.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.data), "bytes": self.bytes,
+            "hits": self.hits, "misses": self.misses}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
 from heapq import heappush, heappop, heapify, heapreplace
 
 class Heap(object):
@@ -32,9 +32,18 @@ def not_found(error):
 def index():
     return jsonify(ok=True)
 
+def server_info():
+    """Return the running server's info, including the status of the other
+    processes when it is running under a supervisor."""
+    server = settings.server
+    info = server.info()
+    if server.supervisor:
+        info["processes"] = server.supervisor.status()
+    return info
+
 @app.route('/info/')
 def info():
-    return jsonify(ok=True)
+    return jsonify(ok=True, **server_info())
 
 @app.route('/plugins/')
 def plugins():
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare header cache record formats:  the zlib compressed json records
+(utils.encode) and the binary records (http.encode_header).
+
+    python bench/header_cache.py
+    python bench/header_cache.py localhost:11211
+
+Record sizes and encode/decode rates are always measured.  Given a memcached
+server, each format is also written there under its own keys and the growth
+in memcached's `bytes` stat and set/get rates are reported."""
+
+import sys
+from time import time
+from hashlib import md5
+
+from arachne import utils, http
+from arachne.memcached import Memcached
+
+samples = [
+    {"if-none-match": '"%s"' % md5("etag").hexdigest()},
+    {"if-modified-since": "Sat, 29 Oct 2011 19:43:31 GMT"},
+    {"if-none-match": '"5e3-4b06ae5c9c7c0"', "if-modified-since": "Wed, 02 Nov 2011 07:08:09 GMT"},
+    {"expires": 1320217689.0},
+]
+
+formats = [
+    ("json+zlib", utils.encode, utils.decode),
+    ("binary", http.encode_header, http.decode_header),
+]
+
+def rate(count, elapsed):
+    return "%d/s" % (count / elapsed) if elapsed else "-"
+
+def main(server=None, count=100000):
+    for name, encode, decode in formats:
+        records = [encode(s) for s in samples]
+        for sample, record in zip(samples, records):
+            assert decode(record) == sample
+        print "%s:" % name
+        print "   record bytes".ljust(20), ", ".join(str(len(r)) for r in records)
+
+        t0 = time()
+        for i in xrange(count):
+            encode(samples[i % len(samples)])
+        print "   encode".ljust(20), rate(count, time() - t0)
+        t0 = time()
+        for i in xrange(count):
+            decode(records[i % len(records)])
+        print "   decode".ljust(20), rate(count, time() - t0)
+
+        if not server:
+            continue
+        host, port = server.split(":")
+        client = Memcached(host=host, port=int(port))
+        keys = ["bench-%s-%s" % (name, md5(str(i)).hexdigest()) for i in xrange(count)]
+        before = int(client.stats()["bytes"])
+        t0 = time()
+        for i, key in enumerate(keys):
+            client.set(key, records[i % len(records)])
+        set_time = time() - t0
+        used = int(client.stats()["bytes"]) - before
+        t0 = time()
+        for key in keys:
+            decode(client.get(key))
+        print "   memcached bytes".ljust(20), "%d (%0.1f per item)" % (used, float(used) / count)
+        print "   memcached set".ljust(20), rate(count, set_time)
+        print "   memcached get".ljust(20), rate(count, time() - t0)
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
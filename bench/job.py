@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare job message formats:  the json messages (`{"path", "args"}`) and
+the binary envelopes (job.Envelope).
+
+    python bench/job.py
+
+Message sizes and encode/decode rates are measured.  Envelope args are
+msgpack encoded when msgpack is installed and json otherwise."""
+
+import sys
+from time import time
+
+#import ujson as json
+import simplejson as json
+
+from arachne import job
+
+samples = [
+    ("twitter/timeline", {"user_id": 123456789}),
+    ("facebook/feed", {"user_id": 1234567, "since": 1320217689}),
+    ("rss/fetch", {"url": "http://example.com/feed.xml"}),
+    ("stats/rollup", {}),
+]
+
+def json_encode(sample):
+    return json.dumps({"path": sample[0], "args": sample[1]})
+
+def json_decode(message):
+    data = json.loads(message)
+    return data["path"], data.get("args", {})
+
+def envelope_encode(sample):
+    return job.Envelope(sample[0], sample[1], time()).encode()
+
+def envelope_decode(message):
+    envelope = job.Envelope.decode(message)
+    return envelope.path, envelope.args
+
+formats = [
+    ("json", json_encode, json_decode),
+    ("envelope", envelope_encode, envelope_decode),
+]
+
+def rate(count, elapsed):
+    return "%d/s" % (count / elapsed) if elapsed else "-"
+
+def main(count=100000):
+    # intern the sample paths as though their plugins were registered
+    for path, args in samples:
+        job._paths[job.method_id(path)] = path
+    print "msgpack:", "yes" if job.msgpack is not None else "no (json args)"
+    for name, encode, decode in formats:
+        messages = [encode(s) for s in samples]
+        for sample, message in zip(samples, messages):
+            assert decode(message) == sample
+        print "%s:" % name
+        print "   message bytes".ljust(20), ", ".join(str(len(m)) for m in messages)
+
+        t0 = time()
+        for i in xrange(count):
+            encode(samples[i % len(samples)])
+        print "   encode".ljust(20), rate(count, time() - t0)
+        t0 = time()
+        for i in xrange(count):
+            decode(messages[i % len(messages)])
+        print "   decode".ljust(20), rate(count, time() - t0)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
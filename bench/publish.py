@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare publishing a message at a time (Amqp.publish) with the batching
+Publisher, with and without confirms.
+
+    python bench/publish.py 100000
+
+The broker is configured by the usual amqp settings.  Messages are published
+to the configured exchange, so run this against a vhost whose queue can be
+thrown away."""
+
+import sys
+from time import time
+
+from arachne import amqp
+
+message = '{"path": "bench/fetch", "args": {"user_id": 123456}}'
+
+def rate(count, elapsed):
+    return "%d/s" % (count / elapsed) if elapsed else "-"
+
+def main(count=100000):
+    client = amqp.Amqp()
+    t0 = time()
+    for i in xrange(count):
+        client.publish(message)
+    print "Amqp.publish".ljust(30), rate(count, time() - t0)
+
+    for confirm in (False, True):
+        publisher = amqp.Publisher(amqp.Amqp(), publish_confirm=confirm)
+        t0 = time()
+        for i in xrange(count):
+            publisher.publish(message)
+        publisher.flush()
+        name = "Publisher (%s)" % ("confirmed" if confirm else "unconfirmed")
+        print name.ljust(30), rate(count, time() - t0), "in %d batches" % publisher.stats["batches"]
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
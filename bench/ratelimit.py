@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the rate limiter backends:  the bucketed windows ("window") and
+the generic cell rate algorithm ("gcra"), along with the leasing limiter.
+
+    python bench/ratelimit.py localhost:11211
+
+Accuracy is measured against a simulated clock:  requests are offered to a
+per-minute limit for an hour of simulated time, either steadily at three
+times the limit or in bursts, and the most requests allowed in any sliding
+minute and the share of the limit used are reported.  Speed is measured
+against real time, taking tokens from a limit high enough never to refuse."""
+
+import sys
+from time import time
+
+from arachne import ratelimit
+from arachne.memcached import Memcached
+
+rate = 100
+
+def steady(seconds):
+    """Requests at three times the limit, evenly spaced."""
+    step = 60.0 / (rate * 3)
+    return [i * step for i in xrange(int(seconds / step))]
+
+def bursty(seconds):
+    """Bursts of twice the limit every 45 seconds."""
+    return [start + i * 0.001 for start in xrange(0, seconds, 45) for i in xrange(rate * 2)]
+
+def max_in_window(times, width=60):
+    """Return the most of a sorted list of times within any width seconds."""
+    best, start = 0, 0
+    for end, t in enumerate(times):
+        while t - times[start] >= width:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+def accuracy(limiter, offered):
+    clock = [1000000000.0]
+    real_time, ratelimit.time = ratelimit.time, lambda: clock[0]
+    allowed = []
+    try:
+        for t in offered:
+            clock[0] = 1000000000.0 + t
+            if limiter.token():
+                allowed.append(t)
+    finally:
+        ratelimit.time = real_time
+    return allowed
+
+def limiters(per_minute):
+    stamp = int(time() * 1000)
+    return [
+        ("window", ratelimit.RateLimit("bench-window-%d" % stamp, per_minute=per_minute)),
+        ("gcra", ratelimit.RateLimit("bench-gcra-%d" % stamp, per_minute=per_minute, backend="gcra")),
+        ("gcra burst=limit", ratelimit.RateLimit("bench-gcrab-%d" % stamp, per_minute=per_minute,
+            backend="gcra", burst=per_minute)),
+        ("leased", ratelimit.LeasedRateLimit("bench-leased-%d" % stamp, per_minute=per_minute)),
+    ]
+
+def main(server, seconds=3600, count=10000):
+    host, port = server.split(":")
+    ratelimit.ratelimit_cache = Memcached(host=host, port=int(port))
+    for pattern in (steady, bursty):
+        offered = pattern(seconds)
+        print "%s: %d requests over %ds, limit %d/minute" % (pattern.__name__, len(offered), seconds, rate)
+        for name, limiter in limiters(rate):
+            allowed = accuracy(limiter, offered)
+            used = len(allowed) / (rate * seconds / 60.0)
+            print "   %s" % name.ljust(17), "max in a minute %d, %0.1f%% of the limit used" % (
+                max_in_window(allowed), used * 100)
+
+    print "speed: %d tokens" % count
+    for name, limiter in limiters(count * 100):
+        t0 = time()
+        for i in xrange(count):
+            limiter.token()
+        elapsed = time() - t0
+        print "   %s" % name.ljust(17), "%d/s" % (count / elapsed)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the scheduler job stores.
+
+    python bench/scheduler.py heap 1000000
+    python bench/scheduler.py wheel 10000000
+
+Each run fills a store with jobs on a mix of plugin intervals, then simulates
+an hour of scheduling one second at a time, popping and rescheduling every
+due job.  Run each backend in its own process so that max RSS is meaningful."""
+
+import sys
+import random
+import resource
+from time import time
+
+from arachne import plugin
+from arachne.scheduler import Job, JobHeap, TimingWheel
+
+intervals = [plugin.half_hourly, plugin.hourly, plugin.hourly, plugin.daily, plugin.daily]
+
+def rss():
+    """Max resident set size in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main(backend="heap", count=1000000, seconds=3600):
+    random.seed(0)
+    start = 1000000000.0
+    jobs = [Job("bench/fetch", {"user_id": i}, random.choice(intervals)) for i in xrange(count)]
+    base = rss()
+
+    store = TimingWheel(1.0, now=start) if backend == "wheel" else JobHeap()
+    t0 = time()
+    for job in jobs:
+        store.schedule(job, start + random.random() * job.interval)
+    insert = time() - t0
+    print "%s: %d jobs" % (backend, count)
+    print "   insert".ljust(20), "%0.2fs (%d/s)" % (insert, count / insert)
+    print "   memory".ljust(20), "%0.1fMB" % (rss() - base)
+
+    popped, t0 = 0, time()
+    for second in xrange(1, seconds + 1):
+        now = start + second
+        for deadline, job in store.pop_due(now):
+            store.schedule(job, deadline + job.interval)
+            popped += 1
+    expire = time() - t0
+    print "   expire+resched".ljust(20), "%0.2fs (%d/s, %d jobs)" % (expire, popped / expire, popped)
+
+    keys = [job.key for job in random.sample(jobs, min(count, 100000))]
+    t0 = time()
+    for key in keys:
+        store.cancel(key)
+    cancel = time() - t0
+    print "   cancel".ljust(20), "%0.2fs (%d/s)" % (cancel, len(keys) / cancel)
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "heap"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    main(backend, count)
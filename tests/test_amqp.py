@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for routing jobs to priority lanes and shards, and for the
+Consumer's weighted gets and batched acks, against fake channels."""
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from arachne import amqp
+from arachne.amqp import Consumer, lane_queues, queues, route
+
+class Channel(object):
+    """Stands in for a channel, recording the acks made on it."""
+    def __init__(self):
+        self.acks = []
+        self.consumers = {}
+
+    def basic_qos(self, size, count, is_global):
+        pass
+
+    def basic_consume(self, queue, callback=None, no_ack=True):
+        self.consumers[queue] = callback
+        return queue
+
+    def basic_cancel(self, tag):
+        del self.consumers[tag]
+
+    def basic_ack(self, tag, multiple=False):
+        self.acks.append((tag, multiple))
+
+    def close(self):
+        pass
+
+class Client(object):
+    """Stands in for an Amqp client."""
+    prefetch_count = 20
+
+    def __init__(self, **kw):
+        self.config = dict(amqp.defaults, queue="jobs", **kw)
+        self.channel = Channel()
+        self.channels = []
+
+    def open_channel(self, prefetch=None):
+        self.channels.append(Channel())
+        return self.channels[-1]
+
+    def reconnect(self):
+        self.channel = Channel()
+
+class Message(object):
+    def __init__(self, tag):
+        self.delivery_tag = tag
+
+def deliver(lane, tags):
+    for tag in tags:
+        lane.channel.consumers[lane.queue](Message(tag))
+
+class ConsumerAckTest(TestCase):
+    def consumer(self, **kw):
+        consumer = Consumer(Client(), size=100, no_ack=False, **kw)
+        consumer.consume()
+        return consumer, consumer.lanes[0]
+
+    def test_batches(self):
+        consumer, lane = self.consumer(ack_every=3)
+        deliver(lane, xrange(1, 8))
+        for i in xrange(7):
+            consumer.ack(consumer.get())
+        # the last batch is acked as soon as nothing more is waiting
+        self.assertEqual(lane.channel.acks, [(3, True), (6, True), (7, True)])
+        self.assertEqual(consumer.stats["acks"], 3)
+        self.assertEqual(consumer.stats["acked"], 7)
+        self.assertEqual(list(lane.delivered), [])
+
+    def test_out_of_order(self):
+        consumer, lane = self.consumer(ack_every=3)
+        deliver(lane, xrange(1, 8))
+        first, second, third = [consumer.get() for i in xrange(3)]
+        consumer.ack(third)
+        consumer.ack(second)
+        self.assertEqual(lane.channel.acks, [])
+        consumer.ack(first)
+        self.assertEqual(lane.channel.acks, [(3, True)])
+
+    def test_slow_message(self):
+        """A message still running doesn't hold back more than a batch of
+        the acks behind it."""
+        consumer, lane = self.consumer(ack_every=3)
+        deliver(lane, xrange(1, 11))
+        messages = [consumer.get() for i in xrange(5)]
+        for message in messages[1:4]:
+            consumer.ack(message)
+        self.assertEqual(lane.channel.acks, [(2, False), (3, False), (4, False)])
+        consumer.ack(messages[4])
+        consumer.ack(messages[0])
+        self.assertEqual(len(lane.channel.acks), 3)
+        self.assertEqual(list(lane.delivered), range(6, 11))
+        consumer.ack(consumer.get())
+        self.assertEqual(lane.channel.acks[3:], [(6, True)])
+        self.assertEqual(consumer.stats["acked"], 6)
+
+    def test_flush(self):
+        consumer, lane = self.consumer(ack_every=10)
+        deliver(lane, xrange(1, 5))
+        consumer.ack(consumer.get())
+        consumer.ack(consumer.get())
+        self.assertEqual(lane.channel.acks, [])
+        consumer.flush()
+        consumer.flush()
+        self.assertEqual(lane.channel.acks, [(2, True)])
+
+    def test_no_ack(self):
+        consumer = Consumer(Client(), no_ack=True)
+        consumer.consume()
+        lane = consumer.lanes[0]
+        deliver(lane, [1])
+        consumer.ack(consumer.get())
+        self.assertEqual(lane.channel.acks, [])
+
+    def test_reconnect(self):
+        """Messages from before a reconnect aren't acked, and those still
+        waiting are dropped, as the broker redelivers them."""
+        consumer, lane = self.consumer(ack_every=3)
+        deliver(lane, xrange(1, 6))
+        running = consumer.get()
+        old = lane.channel
+        consumer.client.reconnect()
+        consumer.consume()
+        self.assertEqual(len(lane.messages), 0)
+        self.assertEqual(consumer.stats["dropped"], 4)
+        self.assertEqual(consumer.space.counter, 100)
+        self.assertEqual(consumer.waiting.counter, 0)
+        consumer.ack(running)
+        self.assertEqual(old.acks + lane.channel.acks, [])
+        deliver(lane, [1])
+        consumer.ack(consumer.get())
+        self.assertEqual(lane.channel.acks, [(1, True)])
+
+class RouteTest(TestCase):
+    def config(self, **kw):
+        return dict(amqp.defaults, queue="jobs", **kw)
+
+    def test_plain_queue(self):
+        config = self.config()
+        self.assertEqual(lane_queues(config), [(None, "jobs", 1)])
+        self.assertEqual(queues(config), ["jobs"])
+        self.assertEqual(route(config, "interactive", "key"), None)
+
+    def test_lane_queues(self):
+        config = self.config(lanes="interactive:10, scheduled:3,backfill", shards=2)
+        self.assertEqual(lane_queues(config), [
+            ("interactive", "jobs.interactive.0", 5.0),
+            ("interactive", "jobs.interactive.1", 5.0),
+            ("scheduled", "jobs.scheduled.0", 1.5),
+            ("scheduled", "jobs.scheduled.1", 1.5),
+            ("backfill", "jobs.backfill.0", 0.5),
+            ("backfill", "jobs.backfill.1", 0.5)])
+        self.assertEqual(queues(self.config(shards=3)), ["jobs.0", "jobs.1", "jobs.2"])
+        self.assertEqual(queues(self.config(lanes="a,b")), ["jobs.a", "jobs.b"])
+
+    def test_route(self):
+        config = self.config(lanes="interactive:10,backfill:1", shards=4)
+        self.assertEqual(route(config, "interactive", "user:1"), route(config, "interactive", "user:1"))
+        # keys spread over the shards, and keep theirs from lane to lane
+        shards = set(route(config, "backfill", "user:%d" % i) for i in xrange(100))
+        self.assertEqual(shards, set("jobs.backfill.%d" % i for i in xrange(4)))
+        for i in xrange(20):
+            key = "user:%d" % i
+            self.assertEqual(route(config, "interactive", key)[-1], route(config, "backfill", key)[-1])
+        # without a key, any shard;  without a known lane, the last one
+        self.assertTrue(route(config, "interactive") in queues(config))
+        self.assertTrue(route(config, "nosuchlane", "k").startswith("jobs.backfill."))
+        config["default_lane"] = "interactive"
+        self.assertTrue(route(config, None, "k").startswith("jobs.interactive."))
+        self.assertEqual(route(self.config(lanes="a,b"), "a", "k"), "jobs.a")
+
+class ConsumerLaneTest(TestCase):
+    def consumer(self, lanes):
+        consumer = Consumer(Client(lanes=lanes), size=1000, no_ack=False)
+        consumer.consume()
+        return consumer
+
+    def test_one_channel_per_lane(self):
+        consumer = self.consumer("interactive:3,backfill:1")
+        channels = [lane.channel for lane in consumer.lanes]
+        self.assertEqual(channels, consumer.client.channels)
+        self.assertEqual([channel.consumers.keys() for channel in channels],
+            [["jobs.interactive"], ["jobs.backfill"]])
+
+    def test_weighted_get(self):
+        consumer = self.consumer("interactive:3,scheduled:2,backfill:1")
+        for lane in consumer.lanes:
+            deliver(lane, xrange(100))
+        taken = [consumer.get().lane.name for i in xrange(60)]
+        self.assertEqual(taken.count("interactive"), 30)
+        self.assertEqual(taken.count("scheduled"), 20)
+        self.assertEqual(taken.count("backfill"), 10)
+        # smooth:  no lane waits for long while the others take turns
+        self.assertTrue("backfill" in taken[:6])
+        self.assertFalse(["interactive"] * 4 in [taken[i:i + 4] for i in xrange(57)])
+
+    def test_empty_lanes_are_skipped(self):
+        consumer = self.consumer("interactive:10,backfill:1")
+        interactive, backfill = consumer.lanes
+        deliver(backfill, xrange(3))
+        deliver(interactive, [0])
+        taken = [consumer.get().lane for i in xrange(4)]
+        self.assertEqual(taken, [interactive, backfill, backfill, backfill])
+        self.assertEqual(consumer.waiting.counter, 0)
+        self.assertEqual(consumer.space.counter, 1000)
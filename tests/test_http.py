@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming parsers, cache records and request coalescing in
+arachne.http."""
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+import gevent
+from gevent.event import Event
+#import ujson as json
+import simplejson as json
+
+from arachne import utils
+from arachne.http import iter_json, iter_json_lines, encode_header, decode_header, \
+    SingleFlight
+
+def splits(doc):
+    """Every way of cutting doc into two chunks."""
+    for i in xrange(len(doc) + 1):
+        yield iter([doc[:i], doc[i:]])
+
+def chunked(doc, size):
+    return iter([doc[i:i + size] for i in xrange(0, len(doc), size)])
+
+class IterJsonTest(TestCase):
+    documents = [
+        '[1.5, -2]',
+        '[1e5, 2]',
+        '[1.5e-3,-20,300]',
+        '[12345678901234567890, 0.25]',
+        '[true, false, null, "a, b]"]',
+        '[{"a": [1, 2.5, {"b": "]"}]}, [], {}]',
+        ' [ ] ',
+    ]
+
+    def test_chunk_splits(self):
+        for doc in self.documents:
+            expected = json.loads(doc)
+            for chunks in splits(doc):
+                self.assertEqual(list(iter_json(chunks)), expected)
+            for size in (1, 2, 3, 7):
+                self.assertEqual(list(iter_json(chunked(doc, size))), expected)
+
+    def test_truncated_numbers(self):
+        self.assertEqual(list(iter_json(iter(['[1.', '5, -2]']))), [1.5, -2])
+        self.assertEqual(list(iter_json(iter(['[1e', '5, 2]']))), [1e5, 2])
+        self.assertEqual(list(iter_json(iter(['[-', '1, 1', '0]']))), [-1, 10])
+
+    def test_not_an_array(self):
+        doc = '  {"x": [1, 2]}'
+        for chunks in splits(doc):
+            self.assertEqual(list(iter_json(chunks)), [{"x": [1, 2]}])
+        self.assertEqual(list(iter_json(iter(['', '  ']))), [])
+
+    def test_errors(self):
+        for doc in ('[1, {"a": ', '[1.x]', '[1, 2'):
+            for chunks in splits(doc):
+                self.assertRaises(ValueError, list, iter_json(chunks))
+
+    def test_json_lines(self):
+        items = [{"a": i, "b": "x" * i} for i in xrange(5)]
+        doc = '\n'.join(json.dumps(item) for item in items) + '\n\n'
+        for size in (1, 4, 100):
+            self.assertEqual(list(iter_json_lines(chunked(doc, size))), items)
+
+class HeaderRecordTest(TestCase):
+    headers = [
+        {},
+        {"if-none-match": '"5e3-4b06ae5c9c7c0"'},
+        {"if-modified-since": "Sat, 29 Oct 2011 19:43:31 GMT"},
+        {"if-none-match": '"etag"', "if-modified-since": "Wed, 02 Nov 2011 07:08:09 GMT"},
+        {"expires": 1320217689.0},
+    ]
+
+    def test_round_trip(self):
+        for header in self.headers:
+            self.assertEqual(decode_header(encode_header(header)), header)
+
+    def test_unicode_and_fractional_expires(self):
+        header = {u"if-none-match": u'"caf\xe9"', "expires": 1320217689.75}
+        self.assertEqual(decode_header(encode_header(header)),
+            {"if-none-match": '"caf\xc3\xa9"', "expires": 1320217689.0})
+
+    def test_legacy_records(self):
+        for header in self.headers:
+            if header:
+                self.assertEqual(decode_header(utils.encode(header)), header)
+
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+        self.release = Event()
+
+    def call(self, result):
+        self.calls.append(result)
+        self.release.wait()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def spawn(self, count, key, result):
+        greenlets = [gevent.spawn(self.flights.do, key, self.call, result)
+            for i in xrange(count)]
+        gevent.sleep(0)
+        return greenlets
+
+    def test_coalesces(self):
+        greenlets = self.spawn(5, "a", 1) + self.spawn(2, "b", 2)
+        self.assertEqual(self.calls, [1, 2])
+        self.release.set()
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value for g in greenlets], [1] * 5 + [2] * 2)
+        self.assertEqual(self.flights.stats, {"requests": 2, "coalesced": 5})
+        self.assertEqual(self.flights.flights, {})
+        # once a call is done, the next one for its key is made again
+        self.assertEqual(self.flights.do("a", lambda: 3), 3)
+
+    def test_shares_exceptions(self):
+        error = ValueError("bad")
+        greenlets = self.spawn(3, "a", error)
+        self.release.set()
+        gevent.joinall(greenlets)
+        self.assertEqual([g.exception for g in greenlets], [error] * 3)
+        self.assertEqual(self.flights.flights, {})
+
+    def test_killed_leader(self):
+        leader, waiter = self.spawn(2, "a", 1)
+        leader.kill()
+        waiter.join()
+        self.assertTrue(isinstance(waiter.exception, RuntimeError))
+        self.assertEqual(self.flights.flights, {})
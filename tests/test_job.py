@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the job envelopes passed from the scheduler to workers."""
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from arachne import job, plugin
+from arachne.job import Envelope
+
+class EnvelopeTestPlugin(plugin.Plugin):
+    def timeline(self, user_id):
+        return {}
+
+    def refresh(self):
+        return {}
+
+path = "envelopetestplugin/timeline"
+
+class EnvelopeTest(TestCase):
+    def setUp(self):
+        self.plugin = EnvelopeTestPlugin()
+
+    def round_trip(self, envelope):
+        decoded = Envelope.decode(envelope.encode())
+        for attr in Envelope.__slots__:
+            self.assertEqual(getattr(decoded, attr), getattr(envelope, attr))
+        return decoded
+
+    def test_round_trip(self):
+        decoded = self.round_trip(Envelope(path, {"user_id": 123456789}, 1320217689.5, 3))
+        self.assertEqual(decoded.method(), self.plugin.timeline)
+        self.round_trip(Envelope(path, {"user_id": u"caf\xe9", "since": [1, 2.5, None]}))
+
+    def test_interned_path(self):
+        """Registered paths are sent as their id alone, and methods without
+        args as just the header."""
+        data = Envelope("envelopetestplugin/refresh").encode()
+        self.assertEqual(len(data), job.header.size)
+        self.assertEqual(self.round_trip(Envelope("envelopetestplugin/refresh")).args, {})
+        flags, mid, deadline, attempts = Envelope.header(data)[0]
+        self.assertEqual(flags, job.NOARGS)
+        self.assertEqual(mid, job.method_id("envelopetestplugin/refresh"))
+
+    def test_unregistered_path(self):
+        envelope = Envelope("nosuchplugin/method", {"a": 1})
+        data = envelope.encode()
+        self.assertTrue(Envelope.header(data)[0][0] & job.PATH)
+        self.assertTrue("nosuchplugin/method" in data)
+        self.assertEqual(self.round_trip(envelope).method(), None)
+
+    def test_legacy_json(self):
+        decoded = Envelope.decode('{"path": "%s", "args": {"user_id": 1}}' % path)
+        self.assertEqual((decoded.path, decoded.args, decoded.deadline, decoded.attempts),
+            (path, {"user_id": 1}, 0, 0))
+
+    def test_invalid(self):
+        data = Envelope(path, {"user_id": 1}).encode()
+        self.assertRaises(ValueError, Envelope.decode, chr(job.version + 1) + data[1:])
+        unknown = job.header.pack(job.version, job.NOARGS, job.method_id("no/such"), 0, 0)
+        self.assertRaises(ValueError, Envelope.decode, unknown)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for placing keys on memcached servers with the ketama ring, and
+for ejecting servers which fail."""
+
+from __future__ import absolute_import
+
+import socket
+from unittest import TestCase
+
+from arachne import memcached
+from arachne.memcached import Ketama, Memcached
+
+servers = ["10.0.0.1:11211", "10.0.0.2:11211", "10.0.0.3:11211", "10.0.0.4:11211"]
+keys = ["key-%d" % i for i in xrange(10000)]
+
+class KetamaTest(TestCase):
+    def placement(self, ring):
+        return dict((key, ring.get(key)) for key in keys)
+
+    def test_points(self):
+        ring = Ketama(servers)
+        self.assertEqual(len(ring.points), 160 * len(servers))
+        self.assertEqual(ring.points, sorted(ring.points))
+        self.assertEqual(Ketama().get("key"), None)
+        self.assertEqual(Ketama(servers[:1]).get("key"), servers[0])
+
+    def test_placement(self):
+        placement = self.placement(Ketama(servers))
+        # the ring doesn't depend on the order servers are listed in
+        self.assertEqual(self.placement(Ketama(reversed(servers))), placement)
+        for server in servers:
+            share = placement.values().count(server) / float(len(keys))
+            self.assertTrue(0.15 < share < 0.35, (server, share))
+
+    def test_removing_a_server(self):
+        before = self.placement(Ketama(servers))
+        after = self.placement(Ketama(servers[1:]))
+        for key in keys:
+            if before[key] != servers[0]:
+                self.assertEqual(after[key], before[key])
+            else:
+                self.assertNotEqual(after[key], servers[0])
+
+    def test_adding_a_server(self):
+        before = self.placement(Ketama(servers))
+        after = self.placement(Ketama(servers + ["10.0.0.5:11211"]))
+        moved = [key for key in keys if after[key] != before[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[key] == "10.0.0.5:11211" for key in moved))
+
+class Client(object):
+    """Stands in for umemcache.Client;  servers in `down` fail every call."""
+    down = set()
+    data = {}
+
+    def __init__(self, server):
+        self.server = server
+
+    def connect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def check(self):
+        if self.server in self.down:
+            raise socket.error("Connection refused")
+
+    def get(self, key):
+        self.check()
+        value = self.data.get((self.server, key))
+        return (value, 0) if value is not None else None
+
+    def set(self, key, value, expiration=0, flags=0, noreply=False):
+        self.check()
+        self.data[(self.server, key)] = value
+        return "STORED"
+
+class Umemcache(object):
+    """Stands in for the umemcache module."""
+    Client = Client
+
+class EjectionTest(TestCase):
+    def setUp(self):
+        self.now = 1000000000.0
+        self.umemcache, memcached.umemcache = memcached.umemcache, Umemcache
+        self.time, memcached.time = memcached.time, lambda: self.now
+        Client.down.clear()
+        Client.data.clear()
+        self.client = Memcached(servers=",".join(servers), max_failures=2, retry_timeout=30)
+        self.key = [key for key in keys if self.client.ring.get(key) == servers[0]][0]
+
+    def tearDown(self):
+        memcached.umemcache = self.umemcache
+        memcached.time = self.time
+
+    def test_eject_and_revive(self):
+        self.client.set(self.key, "a")
+        Client.down.add(servers[0])
+        self.assertRaises(socket.error, self.client.get, self.key)
+        self.assertEqual(self.client.ejected, {})
+        # the second failure in a row ejects the server, and the get is
+        # retried on the server the key has moved to
+        self.assertEqual(self.client.get(self.key), None)
+        self.assertEqual(self.client.ejected, {servers[0]: self.now + 30})
+        self.client.set(self.key, "b")
+        moved = self.client.node(self.key).server
+        self.assertNotEqual(moved, servers[0])
+        self.assertEqual(Client.data[(moved, self.key)], "b")
+        Client.down.clear()
+        self.now += 29
+        self.assertEqual(self.client.get(self.key), "b")
+        self.now += 1
+        self.assertEqual(self.client.get(self.key), "a")
+        self.assertEqual(self.client.ejected, {})
+        self.assertEqual(self.client.nodes[servers[0]].failures, 0)
+
+    def test_success_resets_failures(self):
+        Client.down.add(servers[0])
+        self.assertRaises(socket.error, self.client.get, self.key)
+        Client.down.clear()
+        self.client.get(self.key)
+        Client.down.add(servers[0])
+        self.assertRaises(socket.error, self.client.get, self.key)
+        self.assertEqual(self.client.ejected, {})
+
+    def test_single_server_is_kept(self):
+        client = Memcached(servers=servers[0], max_failures=1)
+        Client.down.add(servers[0])
+        for i in xrange(3):
+            self.assertRaises(socket.error, client.get, self.key)
+        self.assertEqual(client.ejected, {})
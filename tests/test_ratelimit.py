@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the gcra rate limit backend, against a fake memcached client
+and clock."""
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from arachne import ratelimit
+from arachne.ratelimit import RateLimit
+
+start = 1000000000.0
+
+class Cache(object):
+    """Stands in for the memcached client, with the gets/add/cas the gcra
+    backend uses.  The next `conflicts` cas calls fail as if another process
+    had changed the key first."""
+    def __init__(self):
+        self.data = {}
+        self.version = 0
+        self.conflicts = 0
+
+    def store(self, key, value):
+        self.version += 1
+        self.data[key] = (value, self.version)
+
+    def gets(self, key):
+        return self.data.get(key)
+
+    def add(self, key, value, expiration=0):
+        if key in self.data:
+            return False
+        self.store(key, value)
+        return True
+
+    def cas(self, key, value, cas_unique, expiration=0):
+        if self.conflicts:
+            self.conflicts -= 1
+            self.store(key, self.data[key][0])
+            return False
+        if self.data[key][1] != cas_unique:
+            return False
+        self.store(key, value)
+        return True
+
+class GCRATest(TestCase):
+    def setUp(self):
+        self.now = start
+        self.time, ratelimit.time = ratelimit.time, lambda: self.now
+        self.cache, ratelimit.ratelimit_cache = ratelimit.ratelimit_cache, Cache()
+
+    def tearDown(self):
+        ratelimit.time = self.time
+        ratelimit.ratelimit_cache = self.cache
+        ratelimit.limits.pop("gcratest", None)
+
+    def limit(self, **kw):
+        return RateLimit("gcratest", backend="gcra", **kw)
+
+    def test_spacing(self):
+        limit = self.limit(per_minute=60)
+        self.assertTrue(limit.token())
+        self.assertFalse(limit.token())
+        self.assertEqual(limit.retry_after(), 1.0)
+        self.now += 0.999
+        self.assertFalse(limit.token())
+        self.now += 0.001
+        self.assertTrue(limit.token())
+        self.assertFalse(limit.token())
+
+    def test_burst(self):
+        limit = self.limit(per_minute=60, burst=5)
+        self.assertEqual([limit.token() for i in xrange(6)], [True] * 5 + [False])
+        self.now += 1
+        self.assertEqual([limit.token() for i in xrange(2)], [True, False])
+        # once idle, the burst is available again, but no more than it
+        self.now += 60
+        self.assertEqual([limit.token() for i in xrange(6)], [True] * 5 + [False])
+
+    def test_sliding_window(self):
+        """Requests made as fast as they're allowed never exceed rate +
+        burst - 1 in any interval, with no bucket edges to bunch up at."""
+        limit = self.limit(per_minute=30, burst=3)
+        granted = []
+        for step in xrange(18000):
+            self.now = start + step * 0.01
+            if limit.token():
+                granted.append(self.now)
+        for i, t in enumerate(granted):
+            in_window = [g for g in granted[i:] if g < t + 60]
+            self.assertTrue(len(in_window) <= 30 + 3 - 1)
+        self.assertTrue(len(granted) >= 3 * 30)
+
+    def test_every_limit(self):
+        limit = self.limit(per_minute=60, per_hour=90)
+        granted = 0
+        for step in xrange(3600):
+            self.now = start + step
+            granted += limit.token()
+        self.assertEqual(granted, 90)
+
+    def test_cas_conflicts(self):
+        limit = self.limit(per_minute=60, burst=2)
+        self.assertTrue(limit.token())
+        ratelimit.ratelimit_cache.conflicts = 1
+        self.assertTrue(limit.token())
+        ratelimit.ratelimit_cache.conflicts = ratelimit.cas_retries
+        self.now += 10
+        self.assertFalse(limit.token())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the scheduler's job stores, checking the TimingWheel against
+the JobHeap."""
+
+from __future__ import absolute_import
+
+import random
+from unittest import TestCase
+
+from arachne.scheduler import Job, JobHeap, TimingWheel, job_store
+
+start = 1000000000.25
+
+def jobs(count):
+    return [Job("plugin/method", {"i": i}, 60) for i in xrange(count)]
+
+class TimingWheelTest(TestCase):
+    def test_against_heap(self):
+        """The wheel pops what the heap pops, never early and never more
+        than one tick late, over deadlines from the past to beyond the last
+        level's span, with cancels and reschedules along the way."""
+        rand = random.Random(1)
+        for resolution in (1.0, 0.5):
+            wheel, heap = TimingWheel(resolution, now=start), JobHeap()
+            pending = {}
+            for job in jobs(2000):
+                deadline = start + rand.choice([-5, 300, 20000, 3e6, 1e8]) * rand.random()
+                wheel.schedule(job, deadline)
+                heap.schedule(job, deadline)
+                pending[job.key] = job
+            now = start
+            for step in xrange(1000):
+                now += rand.choice([0.3, 1, 7, 500, 40000, 2e6])
+                for i in xrange(rand.randint(0, 3)):
+                    key = rand.choice(pending.keys())
+                    self.assertEqual(wheel.cancel(key), heap.cancel(key))
+                popped = wheel.pop_due(now)
+                popped_keys = set(job.key for deadline, job in popped)
+                for deadline, job in heap.pop_due(now):
+                    if job.key not in popped_keys:
+                        # due in the tick that hasn't ended yet
+                        self.assertTrue(deadline > now - resolution)
+                        heap.schedule(job, deadline)
+                for deadline, job in popped:
+                    self.assertTrue(deadline <= now)
+                    self.assertFalse(job.key in heap)
+                    deadline += rand.choice([10, 3600, 86400, 5e7])
+                    wheel.schedule(job, deadline)
+                    heap.schedule(job, deadline)
+                self.assertEqual(len(wheel), len(heap))
+
+    def test_tick_boundaries(self):
+        """Polled finely, jobs come out after their deadline, and by the end
+        of the tick it falls in."""
+        for resolution in (1.0, 0.5):
+            wheel = TimingWheel(resolution, now=start)
+            deadlines = {}
+            for i, job in enumerate(jobs(100)):
+                deadlines[job.key] = start + i * 0.07
+                wheel.schedule(job, deadlines[job.key])
+            now = start
+            while len(wheel):
+                now += 0.03
+                for deadline, job in wheel.pop_due(now):
+                    self.assertTrue(deadline <= now)
+                    del deadlines[job.key]
+                for deadline in deadlines.itervalues():
+                    self.assertTrue(deadline > now - resolution - 1e-9)
+
+    def test_tick_order(self):
+        wheel = TimingWheel(10.0, now=start)
+        batch = jobs(5)
+        for offset, job in zip([9, 1, 7, 3, 5], batch):
+            wheel.schedule(job, start + offset)
+        popped = wheel.pop_due(start + 20)
+        deadlines = [deadline for deadline, job in popped]
+        self.assertEqual(deadlines, sorted(deadlines))
+        self.assertEqual(len(popped), 5)
+
+    def test_limit(self):
+        wheel = TimingWheel(1.0, now=start)
+        for job in jobs(10):
+            wheel.schedule(job, start - 1)
+        self.assertEqual(len(wheel.pop_due(start, 4)), 4)
+        self.assertEqual(wheel.wait(start), 0)
+        self.assertEqual(len(wheel.pop_due(start)), 6)
+        self.assertEqual(len(wheel), 0)
+
+    def test_schedule_cancel_reschedule(self):
+        wheel = TimingWheel(1.0, now=start)
+        first, second = jobs(2)
+        wheel.schedule(first, start + 100)
+        wheel.schedule(second, start + 200)
+        # scheduling a job again replaces it
+        wheel.schedule(first, start + 300)
+        self.assertEqual(len(wheel), 2)
+        self.assertEqual(wheel.peek(), (start + 200, second))
+        self.assertTrue(wheel.reschedule(second.key, start + 50))
+        self.assertEqual(wheel.peek(), (start + 50, second))
+        self.assertTrue(wheel.cancel(second.key))
+        self.assertFalse(wheel.cancel(second.key))
+        self.assertFalse(wheel.reschedule(second.key, start))
+        self.assertFalse(second.key in wheel)
+        self.assertEqual(wheel.pop_due(start + 299), [])
+        self.assertEqual(wheel.pop_due(start + 302), [(start + 300, first)])
+
+    def test_far_future(self):
+        wheel = TimingWheel(1.0, now=start)
+        job, = jobs(1)
+        deadline = start + 10 ** 10
+        wheel.schedule(job, deadline)
+        self.assertEqual(wheel.pop_due(deadline - 1), [])
+        self.assertEqual(wheel.pop_due(deadline + 1), [(deadline, job)])
+
+class JobStoreTest(TestCase):
+    def test_backends(self):
+        self.assertTrue(isinstance(job_store("heap"), JobHeap))
+        self.assertTrue(isinstance(job_store("wheel", resolution=0.5), TimingWheel))
+        self.assertRaises(ValueError, job_store, "list")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the in-process LRU cache."""
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from arachne import utils
+from arachne.utils import LRUCache
+
+class Clock(object):
+    """Stands in for the time module, so entries can be expired."""
+    def __init__(self, now=1000000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class LRUCacheTest(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.time, utils.time = utils.time, self.clock
+
+    def tearDown(self):
+        utils.time = self.time
+
+    def test_get_set_delete(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("a", 1), 1)
+        cache.set("a", "x")
+        cache.set("a", "y")
+        self.assertEqual(cache.get("a"), "y")
+        self.assertTrue("a" in cache)
+        self.assertEqual(len(cache), 1)
+        cache.delete("a")
+        cache.delete("a")
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(3)
+        for key in "abc":
+            cache.set(key, key)
+        # reading a makes b the least recently used
+        cache.get("a")
+        cache.set("d", "d")
+        self.assertEqual(sorted(cache.data), ["a", "c", "d"])
+        cache.set("c", "c")
+        cache.set("e", "e")
+        self.assertEqual(sorted(cache.data), ["c", "d", "e"])
+
+    def test_maxbytes(self):
+        cache = LRUCache(100, maxbytes=10)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 4)
+        self.assertEqual(cache.bytes, 8)
+        cache.set("c", "x" * 4)
+        self.assertEqual(sorted(cache.data), ["b", "c"])
+        self.assertEqual(cache.bytes, 8)
+        # replacing an entry frees its old size
+        cache.set("c", "x")
+        self.assertEqual(cache.bytes, 5)
+        cache.delete("b")
+        self.assertEqual(cache.bytes, 1)
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_ttl(self):
+        cache = LRUCache(10, maxbytes=100, ttl=10)
+        cache.set("a", "xx")
+        cache.set("b", "xx", ttl=30)
+        cache.set("c", "xx", ttl=0)
+        self.clock.now += 9.5
+        self.assertEqual(cache.get("a"), "xx")
+        self.clock.now += 0.5
+        self.assertEqual(cache.get("a"), None)
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.bytes, 4)
+        self.clock.now += 100
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), "xx")